@@ -10,15 +10,19 @@ import sys
 import csv
 import time
 import math
-from os import remove
+from os import remove, replace, fstat
 from os.path import join, splitext, getsize, exists
-from collections import defaultdict
+from collections import defaultdict, deque
+from functools import partial
 from socket import inet_aton, gethostbyname, gaierror, error
 import multiprocessing as mp
+import queue
 from threading import Thread, Event
 import hashlib
+import json
 import tempfile
-from random import choice
+import struct
+from random import choice, getrandbits
 import ecdsa
 import pandas as pd
 import numpy as np
@@ -35,6 +39,9 @@ from tlslite.utils.cryptomath import bytesToNumber, numberToByteArray
 from tlslite.utils.python_key import Python_Key
 from tlslite.utils.compat import bit_length
 
+from ml_kem_batch import CiphertextFile, PreparedKey, ml_kem_decaps_batch, \
+    read_side_data, read_key_index, SIDE_DATA_KNOWN, ML_KEM_METRICS
+
 try:
     from itertools import izip
 except ImportError: # will be 3.x series
@@ -45,6 +52,41 @@ WAIT_FOR_FIRST_BARE_MAX_VALUE = 0
 WAIT_FOR_NON_BARE_MAX_VALUE = 1
 WAIT_FOR_SECOND_BARE_MAX_VALUE = 2
 
+# number of ciphertexts processed by a worker in one go
+ML_KEM_CHUNK_SIZE = 1000
+
+# number of chunks of ciphertexts that can wait between two stages of
+# the ML-KEM extraction
+ML_KEM_QUEUE_SIZE = 4
+
+# name of the file in the output directory recording progress of the
+# ML-KEM extraction, and how often (in seconds) it's updated
+ML_KEM_CHECKPOINT = "ml-kem-checkpoint.json"
+ML_KEM_CHECKPOINT_INTERVAL = 60
+
+# name of the file in the output directory with the ML-KEM values of
+# every ciphertext, formatted with the hash of the inputs
+ML_KEM_CACHE = "ml-kem-values-{0}.npy"
+
+# number of bytes of the input files hashed in one go
+HASH_BLOCK_SIZE = 1 << 20
+
+# number of rows buffered by NpyWriter before they're written to the file
+NPY_BUFFER_SIZE = 65536
+
+OUTPUT_FORMATS = ("csv", "npy")
+
+BIN_METHODS = ("fixed", "quantile")
+
+# number of times read from a binary file, or rows of timing.csv
+# formatted and written, in one go
+TIMING_BLOCK_SIZE = 65536
+
+# records of the sample info and canary files written by the harnesses
+SAMPLE_INFO_DTYPE = np.dtype([("sequence", "<u8"), ("disturbances", "<u8")])
+CANARY_DTYPE = np.dtype([("sequence", "<u8"), ("time", "<u8"),
+                         ("disturbances", "<u8")])
+
 
 def help_msg():
     """Print help message."""
@@ -58,9 +100,8 @@ def help_msg():
     print(" --raw-times FILE Read the timings from an external file, not")
     print("                the packet capture.")
     print(" --binary num   Expect the raw-times file to store binary numbers")
-    print("                'num' bytes each. Note: using it will overwrite")
-    print("                the csv counterpart to FILE (if FILE is 'data.bin'")
-    print("                it will overwrite 'data.csv'")
+    print("                'num' bytes each. Files with 1, 2, 4 or 8 byte")
+    print("                numbers are memory-mapped and read directly.")
     print(" --endian endian What endianness to use, 'little' or 'big', with")
     print("                little being the default")
     print(" --no-quickack  Don't assume QUICKACK to be in use (affects")
@@ -96,6 +137,31 @@ def help_msg():
     print("                a clock running at frequency 'freq' specified in")
     print("                MHz. Use when the clock source are the raw reads")
     print("                from the Time Stamp Counter register or similar.")
+    print(" --timer-metadata FILE Read the clock frequency from the file")
+    print("                written by time_decapsulate -m, unless")
+    print("                --clock-frequency is specified.")
+    print(" --subtract-overhead Subtract the median time of an empty timed")
+    print("                region, from the --timer-metadata file, from all")
+    print("                the raw times.")
+    print(" --sample-info FILE Read the sequence number and the number of")
+    print("                disturbances (context switches, CPU migrations)")
+    print("                of every raw time from the file written by the")
+    print("                harness -s option. Rows of timing.csv and samples")
+    print("                of the ML-KEM measurements files with disturbed")
+    print("                samples are dropped.")
+    print(" --canary-times FILE Read the canaries written by the harness -C")
+    print("                option. Samples measured between a disturbed")
+    print("                canary and its neighbours are dropped too.")
+    print("                Requires --sample-info.")
+    print(" --max-disturbances num Number of disturbances a sample or canary")
+    print("                can have without being dropped, 0 by default.")
+    print(" --canary-limit factor Canaries slower than factor times the")
+    print("                median canary time are disturbed, 2 by default.")
+    print(" --counters names Comma separated names of the hardware counters")
+    print("                recorded after every time in the binary raw times")
+    print("                file (time_decapsulate -e). The values of every")
+    print("                counter are written to timing-<name>.csv, with")
+    print("                the same rows as timing.csv. Requires --binary.")
     print(" --hash-func func Specifies the hash function to use for")
     print("                extracting the k value. The function should be")
     print("                available in hashlib module. The default function")
@@ -108,15 +174,62 @@ def help_msg():
     print("                for the d, p, q, dP, dQ, and qInv values.")
     print("                Contents must be concatenated PKCS#8 PEM keys.")
     print(" --ml-kem-keys FILE Analyse the time based on ML-KEM keys and")
-    print("                ciphertexts.")
+    print("                ciphertexts. Contents must be concatenated PKCS#8")
+    print("                PEM keys of the same parameter set.")
+    print(" --ml-kem-key-index FILE Read the key index file written by")
+    print("                ml_kem_encap.py with multiple keys, with the")
+    print("                position of the key in the --ml-kem-keys file for")
+    print("                every ciphertext. Required with multiple keys.")
+    print(" --ml-kem-values names Comma separated list of the intermediate")
+    print("                values to extract with --ml-kem-keys, all by")
+    print("                default. Only the parts of decapsulation needed")
+    print("                for them are calculated. Supported values:")
+    for name in ML_KEM_METRICS:
+        print("                {0}".format(name))
+    print(" --resume       Continue an interrupted ML-KEM extraction from")
+    print("                the last checkpoint in the output directory.")
+    print("                Checkpoints are written every {0} seconds,"
+          .format(ML_KEM_CHECKPOINT_INTERVAL))
+    print("                unless --value-bins is used.")
+    print(" --no-ml-kem-cache Don't use the cache of ML-KEM values. By")
+    print("                default the values calculated for every")
+    print("                ciphertext are saved in the output directory, in")
+    print("                a file named after a hash of the ciphertexts, the")
+    print("                key and the list of values. Later extractions")
+    print("                with the same inputs only pair the saved values")
+    print("                with the times, without decapsulating the")
+    print("                ciphertexts (so the side data is not verified).")
+    print(" --ml-kem-side-data FILE Read the side data file written by")
+    print("                ml_kem_encap.py --side-data. Valid ciphertexts")
+    print("                are not re-encrypted and their shared secrets are")
+    print("                verified.")
     print(" --workers num  Number of worker processes to use for")
     print("                parallelizable computation. More workers")
     print("                will finish analysis faster, but will require")
     print("                more memory to do so. By default: number of")
     print("                threads available on the system (`os.cpu_count()`)")
+    print("                Use 1 to process ML-KEM ciphertexts without")
+    print("                starting any worker processes.")
     print(" --max-bit-size num Override the max bit size used in the creation")
     print("                of the tuples. By default the script will try to")
     print("                calculate it. Used only in the bit size extraction")
+    print(" --tuple-size num Number of consecutive samples grouped into")
+    print("                a tuple in the ML-KEM and RSA measurements files.")
+    print("                20 by default.")
+    print(" --value-bins num Group the values in the ML-KEM and RSA")
+    print("                measurements files into 'num' bins, each value")
+    print("                is replaced by the lower edge of its bin. Bins")
+    print("                are computed in a first pass over all values.")
+    print(" --bin-method method How to compute the bins: 'fixed' for bins")
+    print("                of equal width (default), 'quantile' for bins")
+    print("                with a similar number of samples each.")
+    print(" --output-format fmt Format of the timing.csv and ML-KEM and RSA")
+    print("                measurements files: 'csv' (default), 'npy' or")
+    print("                'csv,npy' for both. 'npy' files hold numpy")
+    print("                structured arrays, one field per class in")
+    print("                timing.npy and 'tuple', 'value' and 'time' fields")
+    print("                in measurements files. Load them with")
+    print("                numpy.load(file, mmap_mode='r').")
     print(" --verbose      Print's a more verbose output.")
     print(" --help         Display this message")
     print("")
@@ -154,6 +267,13 @@ def main():
     binary = None
     endian = 'little'
     no_quickack = False
+    timer_metadata = None
+    subtract_overhead = False
+    sample_info = None
+    canary_times = None
+    max_disturbances = 0
+    canary_limit = 2.0
+    counters = None
     delay = None
     carriage_return = None
     data = None
@@ -174,6 +294,15 @@ def main():
     max_bit_size = None
     verbose = False
     ml_kem_keys = None
+    ml_kem_side_data = None
+    ml_kem_key_index = None
+    ml_kem_values = None
+    resume = False
+    ml_kem_cache = True
+    output_formats = ("csv",)
+    tuple_size = 20
+    value_bins = None
+    bin_method = "fixed"
 
     argv = sys.argv[1:]
 
@@ -189,9 +318,18 @@ def main():
                                 "raw-values=", "value-size=",
                                 "value-endianness=", "priv-key-ecdsa=",
                                 "clock-frequency=", "hash-func=",
+                                "timer-metadata=", "subtract-overhead",
+                                "sample-info=", "canary-times=",
+                                "max-disturbances=", "canary-limit=",
+                                "counters=",
                                 "skip-invert", "workers=", "rsa-keys=",
                                 "max-bit-size=", "verbose",
-                                "ml-kem-keys="])
+                                "ml-kem-keys=", "ml-kem-side-data=",
+                                "ml-kem-key-index=",
+                                "output-format=", "tuple-size=",
+                                "value-bins=", "bin-method=",
+                                "ml-kem-values=", "resume",
+                                "no-ml-kem-cache"])
     for opt, arg in opts:
         if opt == '-l':
             logfile = arg
@@ -237,6 +375,16 @@ def main():
             rsa_keys = arg
         elif opt == "--ml-kem-keys":
             ml_kem_keys = arg
+        elif opt == "--ml-kem-side-data":
+            ml_kem_side_data = arg
+        elif opt == "--ml-kem-key-index":
+            ml_kem_key_index = arg
+        elif opt == "--ml-kem-values":
+            ml_kem_values = tuple(arg.split(","))
+        elif opt == "--resume":
+            resume = True
+        elif opt == "--no-ml-kem-cache":
+            ml_kem_cache = False
         elif opt == "--priv-key-ecdsa":
             priv_key = arg
             if not key_type:
@@ -248,6 +396,20 @@ def main():
             verbose = True
         elif opt == "--clock-frequency":
             freq = float(arg) * 1e6
+        elif opt == "--timer-metadata":
+            timer_metadata = arg
+        elif opt == "--subtract-overhead":
+            subtract_overhead = True
+        elif opt == "--sample-info":
+            sample_info = arg
+        elif opt == "--canary-times":
+            canary_times = arg
+        elif opt == "--max-disturbances":
+            max_disturbances = int(arg)
+        elif opt == "--canary-limit":
+            canary_limit = float(arg)
+        elif opt == "--counters":
+            counters = tuple(arg.split(","))
         elif opt == "--hash-func":
             hash_func_name = arg
         elif opt == "--skip-invert":
@@ -256,6 +418,14 @@ def main():
             workers = int(arg)
         elif opt == "--max-bit-size":
             max_bit_size = int(arg)
+        elif opt == "--tuple-size":
+            tuple_size = int(arg)
+        elif opt == "--value-bins":
+            value_bins = int(arg)
+        elif opt == "--bin-method":
+            bin_method = arg
+        elif opt == "--output-format":
+            output_formats = tuple(arg.split(","))
         elif opt == "--help":
             help_msg()
             sys.exit(0)
@@ -320,11 +490,18 @@ def main():
         binary=binary, endian=endian, no_quickack=no_quickack,
         delay=delay, carriage_return=carriage_return,
         data=data, data_size=data_size, sigs=sigs, priv_key=priv_key,
-        key_type=key_type, frequency=freq, hash_func=hash_func,
+        key_type=key_type, frequency=freq, timer_metadata=timer_metadata,
+        subtract_overhead=subtract_overhead, sample_info=sample_info,
+        canary_times=canary_times, max_disturbances=max_disturbances,
+        canary_limit=canary_limit, counters=counters, hash_func=hash_func,
         workers=workers, verbose=verbose, rsa_keys=rsa_keys,
         sig_format=sig_format, values=values, value_size=value_size,
         value_endianness=value_endianness, max_bit_size=max_bit_size,
-        ml_kem_keys=ml_kem_keys
+        ml_kem_keys=ml_kem_keys, ml_kem_side_data=ml_kem_side_data,
+        ml_kem_key_index=ml_kem_key_index, output_formats=output_formats,
+        tuple_size=tuple_size, value_bins=value_bins, bin_method=bin_method,
+        ml_kem_values=ml_kem_values, resume=resume,
+        ml_kem_cache=ml_kem_cache
     )
     extract.parse()
 
@@ -351,6 +528,347 @@ def main():
         extract.process_ml_kem_keys()
 
 
+def _npy_header(dtype, count, size):
+    """Return a version 1.0 .npy header padded to size bytes."""
+    magic = np.lib.format.magic(1, 0)
+    header = repr({"descr": np.lib.format.dtype_to_descr(dtype),
+                   "fortran_order": False,
+                   "shape": (count,)}).encode("latin1")
+    header += b" " * (size - len(magic) - 2 - len(header) - 1) + b"\n"
+    return magic + struct.pack("<H", len(header)) + header
+
+
+class NpyWriter(object):
+    """
+    Write a one-dimensional structured array to a .npy file in chunks.
+
+    Rows are buffered and appended to the file in large chunks. The header
+    is rewritten after every chunk, so the file is always a valid .npy file
+    that can be memory-mapped with numpy.load(filename, mmap_mode="r").
+    """
+
+    def __init__(self, filename, dtype, buffer_size=NPY_BUFFER_SIZE,
+                 size=None):
+        """
+        Create the file.
+
+        :param str filename: name of the .npy file to create
+        :param dtype: numpy structured dtype of the rows
+        :param int buffer_size: number of rows to collect before writing
+            them to the file
+        :param int size: if set, the existing file is truncated to size
+            bytes and new rows are appended to it
+        """
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.buffer_size = buffer_size
+        self.count = 0
+        self._rows = []
+        # reserve enough space for the header of an array of any length
+        self._header_size = len(_npy_header(self.dtype, 2**63, 0))
+        self._header_size = -(-self._header_size // 64) * 64
+        if size is None:
+            self._fp = open(filename, "w+b")
+        else:
+            self._fp = open(filename, "r+b")
+            self._fp.truncate(size)
+            self.count = (size - self._header_size) // self.dtype.itemsize
+        self._fp.write(_npy_header(self.dtype, self.count, self._header_size))
+
+    def write(self, row):
+        """Queue a single row (a tuple with a value for every field)."""
+        self._rows.append(row)
+        if len(self._rows) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write the queued rows to the file."""
+        if not self._rows:
+            return
+        data = np.array(self._rows, dtype=self.dtype)
+        self._rows = []
+        self._append(data)
+
+    def write_array(self, data):
+        """Write a structured array of rows, after the queued rows."""
+        self.flush()
+        self._append(np.asarray(data, dtype=self.dtype))
+
+    def _append(self, data):
+        self._fp.seek(0, 2)
+        self._fp.write(data.tobytes())
+        self.count += len(data)
+        self._fp.seek(0)
+        self._fp.write(_npy_header(self.dtype, self.count, self._header_size))
+        self._fp.flush()
+
+    def size(self):
+        """Return the size of the file with all the written rows."""
+        return self._header_size + self.count * self.dtype.itemsize
+
+    def close(self):
+        """Write the remaining rows and close the file."""
+        if self._fp:
+            self.flush()
+            self._fp.close()
+            self._fp = None
+
+
+class MeasurementsWriter(object):
+    """
+    Writer of a measurements file in the selected output formats.
+
+    The CSV file has the "tuple,value,time" rows without a header, the
+    .npy file has the same columns as the fields of a structured array.
+    """
+
+    dtype = np.dtype([("tuple", "<u8"), ("value", "<i8"), ("time", "<f8")])
+
+    def __init__(self, name, output_formats=("csv",), sizes=None):
+        """
+        Create the files.
+
+        :param str name: file name without the extension
+        :param tuple output_formats: "csv", "npy" or both
+        :param dict sizes: if set, continue writing existing files,
+            truncated to the sizes returned by flush()
+        """
+        self._csv = None
+        self._npy = None
+        if "csv" in output_formats:
+            if sizes is None:
+                self._csv = open(name + ".csv", "wt")
+            else:
+                with open(name + ".csv", "r+b") as csv_fp:
+                    csv_fp.truncate(sizes["csv"])
+                self._csv = open(name + ".csv", "at")
+        if "npy" in output_formats:
+            self._npy = NpyWriter(name + ".npy", self.dtype,
+                                  size=sizes and sizes["npy"])
+
+    def write(self, tuple_nums, values, times):
+        """Write measurements given as arrays of the same length."""
+        if self._csv:
+            self._csv.write("".join(
+                "{0},{1},{2}\n".format(*i) for i in
+                zip(tuple_nums.tolist(), values.tolist(), times.tolist())))
+        if self._npy:
+            data = np.empty(len(tuple_nums), dtype=self.dtype)
+            data["tuple"] = tuple_nums
+            data["value"] = values
+            data["time"] = times
+            self._npy.write_array(data)
+
+    def flush(self):
+        """Write out buffered measurements, return sizes of the files."""
+        sizes = {}
+        if self._csv:
+            self._csv.flush()
+            sizes["csv"] = fstat(self._csv.fileno()).st_size
+        if self._npy:
+            self._npy.flush()
+            sizes["npy"] = self._npy.size()
+        return sizes
+
+    def close(self):
+        """Flush the buffered measurements and close the files."""
+        if self._csv:
+            self._csv.close()
+        if self._npy:
+            self._npy.close()
+
+
+class TupleSelector(object):
+    """
+    Groups measurements into tuples and writes them to measurements files.
+
+    Every max_len consecutive samples form a tuple. For every distinct
+    value in a tuple, one sample with that value, picked at random, is
+    written, in order of increasing values. Samples with NaN times, dropped
+    as disturbed, are picked only if there is no other sample with the
+    value, and then not written.
+
+    If bins are requested, the values are replaced by the lower edge of
+    their bin. As the bins depend on all the values, the samples are then
+    only stored in temporary files and a histogram of every value is
+    collected. The tuples are created once all the samples were added.
+    """
+
+    def __init__(self, measurements, max_len, bins=None, bin_method="fixed"):
+        """
+        Set up the selector.
+
+        :param dict measurements: MeasurementsWriter for every value name
+        :param int max_len: number of samples in a tuple
+        :param int bins: number of bins to group the values into, None
+            to use the values as is
+        :param str bin_method: "fixed" for bins of equal width,
+            "quantile" for bins with a similar number of samples
+        """
+        self.measurements = measurements
+        self.max_len = max_len
+        self.bins = bins
+        self.bin_method = bin_method
+        self.tuple_num = 0
+        # number of samples in the tuples written so far
+        self.written = 0
+        self._rng = np.random.default_rng(getrandbits(128))
+        self._values = dict((i, []) for i in measurements)
+        self._times = []
+        self._pending = 0
+        self._edges = None
+        self._histograms = None
+        self._files = None
+        self._times_dtype = None
+        if bins:
+            self._histograms = dict((i, defaultdict(int))
+                                    for i in measurements)
+            self._files = dict((i, tempfile.TemporaryFile())
+                               for i in measurements)
+            self._files[None] = tempfile.TemporaryFile()
+
+    def add(self, values, times):
+        """
+        Queue samples and write all complete tuples.
+
+        :param dict values: array of values for every value name
+        :param numpy.ndarray times: times of the samples
+        """
+        if self.bins and self._edges is None:
+            self._store(values, times)
+            return
+
+        for name, v in self._values.items():
+            v.append(self._bin(name, np.asarray(values[name])))
+        self._times.append(np.asarray(times))
+        self._pending += len(times)
+
+        if self._pending >= self.max_len:
+            self._write(self._pending // self.max_len * self.max_len)
+
+    def get_state(self):
+        """Return the state needed to continue creating tuples later."""
+        return {"tuple_num": self.tuple_num, "written": self.written,
+                "rng": self._rng.bit_generator.state}
+
+    def set_state(self, state):
+        """
+        Continue creating tuples after the samples written in state.
+
+        The next added sample must be the sample number state["written"].
+        """
+        if self.bins or self._pending:
+            raise ValueError("Can't restore state of a used selector or "
+                             "one that uses bins.")
+        self.tuple_num = state["tuple_num"]
+        self.written = state["written"]
+        self._rng.bit_generator.state = state["rng"]
+
+    def close(self):
+        """Write the last, incomplete, tuple."""
+        if self.bins and self._edges is None:
+            self._edges = dict((name, self._bin_edges(hist))
+                               for name, hist in self._histograms.items())
+            self._replay()
+
+        if self._pending:
+            self._write(self._pending)
+
+    def _store(self, values, times):
+        """Save samples for the second pass, update the histograms."""
+        times = np.asarray(times)
+        if self._times_dtype is None:
+            self._times_dtype = times.dtype
+        times.astype(self._times_dtype).tofile(self._files[None])
+
+        for name, hist in self._histograms.items():
+            v = np.asarray(values[name], dtype=np.int64)
+            v.tofile(self._files[name])
+            for value, count in zip(*np.unique(v, return_counts=True)):
+                hist[int(value)] += int(count)
+
+    def _replay(self):
+        """Add the samples saved in the first pass."""
+        for fp in self._files.values():
+            fp.seek(0)
+
+        while True:
+            times = np.fromfile(self._files[None], dtype=self._times_dtype,
+                                count=TIMING_BLOCK_SIZE)
+            if not len(times):
+                break
+            values = dict(
+                (name, np.fromfile(self._files[name], dtype=np.int64,
+                                   count=len(times)))
+                for name in self._histograms)
+            self.add(values, times)
+
+        for fp in self._files.values():
+            fp.close()
+        self._files = None
+
+    def _bin_edges(self, histogram):
+        """Calculate lower edges of the bins for values in histogram."""
+        if not histogram:
+            return None
+
+        values = np.array(sorted(histogram), dtype=np.int64)
+        if self.bin_method == "fixed":
+            low, high = int(values[0]), int(values[-1])
+            width = max(1, -(-(high - low + 1) // self.bins))
+            return np.arange(low, high + 1, width, dtype=np.int64)
+
+        # quantile bins, a bin starts with the value at which the
+        # cumulative count reaches the next multiple of total / bins
+        counts = np.array([histogram[i] for i in values.tolist()])
+        cumulative = np.cumsum(counts) - counts
+        total = cumulative[-1] + counts[-1]
+        bin_ids = cumulative * self.bins // total
+        first = np.ones(len(values), dtype=bool)
+        first[1:] = bin_ids[1:] != bin_ids[:-1]
+        return values[first]
+
+    def _bin(self, name, values):
+        """Replace values with lower edges of their bins."""
+        if self._edges is None or self._edges[name] is None:
+            return values
+        edges = self._edges[name]
+        return edges[np.searchsorted(edges, values, side="right") - 1]
+
+    def _write(self, count):
+        times = np.concatenate(self._times)
+        self._times = [times[count:]]
+        times = times[:count]
+
+        tuple_nums = self.tuple_num + np.arange(count) // self.max_len
+        random_keys = self._rng.random(count)
+        dropped = np.zeros(count, dtype=bool)
+        if times.dtype.kind == "f":
+            dropped = np.isnan(times)
+
+        for name, v in self._values.items():
+            values = np.concatenate(v)
+            self._values[name] = [values[count:]]
+            values = values[:count]
+
+            # sort by tuple, value, dropped samples last, and a random key,
+            # so the first sample of every (tuple, value) group is
+            # a randomly selected one
+            order = np.lexsort((random_keys, dropped, values, tuple_nums))
+            first = np.ones(count, dtype=bool)
+            first[1:] = (tuple_nums[order][1:] != tuple_nums[order][:-1]) | \
+                (values[order][1:] != values[order][:-1])
+            selected = order[first]
+            selected = selected[~dropped[selected]]
+
+            self.measurements[name].write(
+                tuple_nums[selected], values[selected], times[selected])
+
+        self._pending -= count
+        self.written += count
+        self.tuple_num += -(-count // self.max_len)
+
+
 class Extract:
     """Extract timing information from packet capture."""
 
@@ -361,10 +879,17 @@ class Extract:
                  binary=None, endian='little', no_quickack=False, delay=None,
                  carriage_return=None, data=None, data_size=None, sigs=None,
                  priv_key=None, key_type=None, frequency=None,
+                 timer_metadata=None, subtract_overhead=False,
+                 sample_info=None, canary_times=None, max_disturbances=0,
+                 canary_limit=2.0, counters=None,
                  hash_func=hashlib.sha256, workers=None, verbose=False,
                  fin_as_resp=False, rsa_keys=None, sig_format="DER",
                  values=None, value_size=None, value_endianness="little",
-                 max_bit_size=None, ml_kem_keys=None):
+                 max_bit_size=None, ml_kem_keys=None,
+                 ml_kem_side_data=None, ml_kem_key_index=None,
+                 output_formats=("csv",),
+                 tuple_size=20, value_bins=None, bin_method="fixed",
+                 ml_kem_values=None, resume=False, ml_kem_cache=True):
         """
         Initialises instance and sets up class name generator from log.
 
@@ -388,6 +913,25 @@ class Extract:
         :param int binary: Number of bytes per timing from raw times file
         :param str endian: Endianess of the read numbers
         :param bool no_quickack: If True, don't expect QUICKACK to be in use
+        :param float frequency: Frequency of the clock of the raw times,
+            in Hz, None if they are in seconds
+        :param str timer_metadata: File with the clock frequency and the
+            timer overhead measured by the harness, the frequency is used
+            if frequency is not set
+        :param bool subtract_overhead: Subtract the median timer overhead
+            from timer_metadata from the raw times
+        :param str sample_info: File with the sequence number and number of
+            disturbances of every raw time, disturbed samples are dropped
+        :param str canary_times: File with the sequence number, time and
+            number of disturbances of the canaries, samples next to
+            disturbed canaries are dropped
+        :param int max_disturbances: Number of disturbances of a sample or
+            canary that doesn't make it disturbed
+        :param float canary_limit: Canaries slower than canary_limit times
+            the median canary are disturbed
+        :param tuple counters: Names of the hardware counters recorded in
+            the binary raw times file after every time, their values are
+            written to timing-<name>.csv files
         :param float delay: How often to print the status line.
         :param str carriage_return: What chacarter to use as status line end.
         :param func hash_func: The hash function that will be used for hashing
@@ -396,6 +940,23 @@ class Extract:
         :param bool verbose: Prints a more verbose output
         :param bool fin_as_resp: Consider the server FIN packet to be the
             response to previous client query
+        :param str ml_kem_key_index: File with the index of the key in
+            the ml_kem_keys file for every ML-KEM ciphertext
+        :param tuple output_formats: Formats in which to write the timing
+            and measurements files, "csv", "npy" or both
+        :param int tuple_size: Number of samples in a tuple of the ML-KEM
+            and RSA measurements files
+        :param int value_bins: Number of bins to group the values of the
+            ML-KEM and RSA measurements files into, None for no grouping
+        :param str bin_method: "fixed" for bins of equal width, "quantile"
+            for bins with equal number of samples
+        :param tuple ml_kem_values: Names of the ML-KEM intermediate values
+            to extract, None for all
+        :param bool resume: Continue the ML-KEM extraction from the last
+            checkpoint in the output directory
+        :param bool ml_kem_cache: Read the ML-KEM values from the cache in
+            the output directory if it matches the inputs, create it
+            otherwise
         """
         self.capture = capture
         self.output = output
@@ -430,6 +991,29 @@ class Extract:
         self.sigs = sigs
         self.r_or_s_size = None
         self.frequency = frequency
+        self.timer_overhead = 0
+        if timer_metadata:
+            with open(timer_metadata, "r") as metadata_fp:
+                metadata = json.load(metadata_fp)
+            if self.frequency is None:
+                self.frequency = metadata["clock_frequency"] * 1e6
+            if subtract_overhead:
+                self.timer_overhead = metadata["overhead"]["median"]
+        elif subtract_overhead:
+            raise ValueError(
+                "Subtracting the timer overhead requires timer metadata.")
+        if canary_times and not sample_info:
+            raise ValueError(
+                "Canary times require the sample info file.")
+        self.sample_info = sample_info
+        self.canary_times = canary_times
+        self.max_disturbances = max_disturbances
+        self.canary_limit = canary_limit
+        self._disturbed = None
+        self.counters = tuple(counters or ())
+        if self.counters and binary not in (1, 2, 4, 8):
+            raise ValueError(
+                "Counters require binary raw times of 1, 2, 4 or 8 bytes.")
         self.measurements_csv = measurements_csv
         self.hash_func = hash_func  # None if data are already hashed
         self.workers = workers
@@ -453,6 +1037,45 @@ class Extract:
         self.value_endianness = value_endianness
         self.max_bit_size = max_bit_size
         self.ml_kem_keys = ml_kem_keys
+        self.ml_kem_side_data = ml_kem_side_data
+        self.ml_kem_key_index = ml_kem_key_index
+        self.output_formats = output_formats
+        self._timing_npy = None
+        self.tuple_size = tuple_size
+        self.value_bins = value_bins
+        self.bin_method = bin_method
+        self.ml_kem_values = ml_kem_values
+        self.resume = resume
+        self.ml_kem_cache = ml_kem_cache
+
+        if resume and value_bins:
+            raise ValueError(
+                "Resuming extraction with value bins is not supported.")
+
+        if ml_kem_values is not None:
+            for name in ml_kem_values:
+                if name not in ML_KEM_METRICS:
+                    raise ValueError(
+                        "Unknown ML-KEM value {0}. ".format(name) +
+                        "Supported values: {0}".format(
+                            ", ".join(ML_KEM_METRICS)))
+
+        if tuple_size < 1:
+            raise ValueError("Tuple size must be a positive number.")
+
+        if value_bins is not None and value_bins < 1:
+            raise ValueError("Number of bins must be a positive number.")
+
+        if bin_method not in BIN_METHODS:
+            raise ValueError(
+                "Unknown bin method {0}. ".format(bin_method) +
+                "Please use 'fixed' or 'quantile'.")
+
+        if not output_formats or \
+                any(i not in OUTPUT_FORMATS for i in output_formats):
+            raise ValueError(
+                "Unknown output format {0}. ".format(",".join(output_formats))
+                + "Please use 'csv', 'npy' or 'csv,npy'.")
 
         if sig_format not in ["DER", "RAW"]:
             raise ValueError(
@@ -488,15 +1111,6 @@ class Extract:
             return self._parse_pcap()
         return self._parse_raw_times()
 
-    def _convert_binary_file(self, raw_times_name):
-        """Convert the binary file format to csv before further processing."""
-        times_iter = self._get_time_from_file()
-
-        with open(raw_times_name, 'w') as raw_times:
-            raw_times.write("raw times\n")
-            for val in times_iter:
-                raw_times.write(str(val) + '\n')
-
     def _parse_raw_times(self):
         """Classify already extracted times."""
         # as unlike with capture file, we don't know how many sanity tests,
@@ -505,45 +1119,163 @@ class Extract:
         # skip. Count the probes, the times, and then use the last len(probes)
         # of times for classification
 
-        raw_times_name = self.raw_times
-
-        # if we got a binary file on input, first transform it into a csv file
-        if self.binary:
-            raw_times_name = splitext(self.raw_times)[0] + ".csv"
-            self._convert_binary_file(raw_times_name)
-
         if not self.log:
             return
 
-        # do counting in memory efficient way
-        probe_count = sum(1 for _ in self.class_generator)
-        self.log.read_log()
-        self.class_generator = self.log.iterate_log()
-        with open(raw_times_name, 'r') as raw_times:
-            # skip the header line
-            raw_times.readline()
-            times_count = 0
-            for times_count, _ in enumerate(raw_times, 1):
-                pass
+        # the order in which the probes were executed, as class indexes
+        classes = np.fromiter(self.class_generator, dtype=np.intp)
+        probe_count = len(classes)
+
+        times = self._read_times_array().astype(np.float64)
+        times_count = len(times)
         if probe_count > times_count:
             raise ValueError(
                 "Insufficient number of times for provided log file "
                 "(expected: {0}, found: {1})".format(probe_count, times_count))
+        disturbed = self._disturbed_samples(times_count)
 
         self.warm_up_messages_left = times_count - probe_count
+        times = times[self.warm_up_messages_left:]
+
+        # group the times by class, keeping the order of execution,
+        # like with the capture, only complete rows are written
+        order = np.argsort(classes, kind="stable")
+        counts = np.bincount(classes, minlength=len(self.class_names))
+        starts = np.concatenate(([0], np.cumsum(counts)))
+        class_names = sorted(
+            (self.class_names[i] for i in range(len(self.class_names))
+             if counts[i]),
+            key=natural_sort_keys)
+
+        dropped = None
+        if disturbed is not None:
+            # drop complete rows, so that the classes stay paired, the
+            # row of a sample is its position among the samples of its class
+            disturbed = disturbed[self.warm_up_messages_left:]
+            rows = np.empty(probe_count, dtype=np.intp)
+            rows[order] = np.arange(probe_count) - \
+                np.repeat(starts[:-1], counts)
+            dropped = np.unique(rows[disturbed])
+
+        def class_columns(values):
+            """Return the values of every class, in order of class_names."""
+            columns = dict(
+                (self.class_names[i], values[order[starts[i]:starts[i + 1]]])
+                for i in range(len(self.class_names)) if counts[i])
+            if dropped is not None:
+                for name, column in columns.items():
+                    columns[name] = np.delete(
+                        column, dropped[dropped < len(column)])
+            return [columns[i] for i in class_names]
+
+        self._write_csv_header(class_names)
+        self._write_timing_columns(class_columns(times))
+        self._close_timing_files()
+
+        # every hardware counter recorded with the times gets its own file
+        write_csv = self.write_csv
+        name, ext = splitext(write_csv)
+        try:
+            for column, counter in enumerate(self.counters, 1):
+                values = self._read_binary_times(column)
+                self.write_csv = "{0}-{1}{2}".format(name, counter, ext)
+                self._write_class_names = None
+                self._write_csv_header(class_names)
+                self._write_timing_columns(class_columns(
+                    values[self.warm_up_messages_left:].astype(np.float64)))
+                self._close_timing_files()
+        finally:
+            self.write_csv = write_csv
 
-        data_iter = self._get_time_from_file()
-        for _ in range(self.warm_up_messages_left):
-            next(data_iter)
+    def _disturbed_samples(self, count):
+        """
+        Return the boolean array marking the count raw times measured with
+        disturbances, None if there is no sample info file.
 
-        for line in data_iter:
-            class_index = next(self.class_generator)
-            class_name = self.class_names[class_index]
-            self.timings[class_name].append(line)
-            self._flush_to_files()
+        A sample is disturbed if it had more than max_disturbances
+        disturbances, or was measured between two canaries of which one
+        had more disturbances or was slower than canary_limit times the
+        median canary.
+        """
+        if not self.sample_info:
+            return None
+        if self._disturbed is not None:
+            return self._disturbed
 
-        self._write_csv_header()
-        self._write_csv()
+        info = np.fromfile(self.sample_info, dtype=SAMPLE_INFO_DTYPE)
+        if len(info) != count:
+            raise ValueError(
+                "Sample info doesn't match the raw times "
+                "(expected: {0} records, found: {1})".format(
+                    count, len(info)))
+        disturbed = info["disturbances"] > self.max_disturbances
+
+        if self.canary_times:
+            canaries = np.fromfile(self.canary_times, dtype=CANARY_DTYPE)
+            if len(canaries):
+                bad = (canaries["disturbances"] > self.max_disturbances) | \
+                    (canaries["time"] >
+                     self.canary_limit * np.median(canaries["time"]))
+                # with a canary before the first and after the last sample
+                bad = np.concatenate(([False], bad, [False]))
+                after = np.searchsorted(canaries["sequence"],
+                                        info["sequence"])
+                disturbed |= bad[after] | bad[after + 1]
+
+        print("Dropping {0} of {1} samples measured with disturbances"
+              .format(np.count_nonzero(disturbed), count))
+        self._disturbed = disturbed
+        return disturbed
+
+    def _read_times_array(self, scale=True):
+        """
+        Read all the times from the raw times file as a numpy array.
+
+        Binary files are memory-mapped, for csv files uses the column
+        selected by col_name if the file has more columns.
+        If scale is set, times are divided by frequency if one was
+        specified, otherwise times from binary files remain integers.
+        """
+        filename = self.raw_times
+
+        if self.binary:
+            times = self._read_binary_times()
+            if times is None:
+                times = np.fromiter(self._get_data_from_binary_file(
+                    filename, self.binary, convert_to_int=True),
+                    dtype=np.uint64)
+        else:
+            with open(filename, "r") as data_fp:
+                columns = next(csv.reader(data_fp))
+
+            if len(columns) > 1 and self.col_name is None:
+                raise ValueError(
+                    "Multiple columns in {0} and ".format(filename) +
+                    "no column name specified!"
+                )
+            column = 0
+            if self.col_name:
+                column = columns.index(self.col_name)
+
+            # round_trip parses the numbers exactly like float() does
+            times = pd.read_csv(filename, usecols=[column], dtype=np.float64,
+                                float_precision="round_trip").iloc[:, 0]
+            times = times.to_numpy()
+
+        if scale and self.frequency:
+            times = self._scale_times(times)
+
+        return times
+
+    def _scale_times(self, times):
+        """
+        Convert an array of raw times in clock ticks to seconds.
+
+        Subtracts the timer overhead and divides by frequency.
+        """
+        if self.timer_overhead:
+            times = np.subtract(times, self.timer_overhead, dtype=np.float64)
+        return times / self.frequency
 
     def _parse_pcap(self):
         """Process capture file."""
@@ -685,6 +1417,7 @@ class Extract:
 
                 # deal with the last connection
                 self.add_timing()
+                self._close_timing_files()
             finally:
                 status[2].set()
                 progress.join()
@@ -751,28 +1484,75 @@ class Extract:
         # finally write the times of already sorted classes
         self._write_csv()
 
-    def _write_csv_header(self):
+    def _write_csv_header(self, class_names=None):
         if self._write_class_names is not None:
             return
 
+        if class_names is None:
+            class_names = sorted(self.timings, key=natural_sort_keys)
+        self._write_class_names = class_names
+
         filename = join(self.output, self.write_csv)
-        with open(filename, 'w') as csvfile:
+        if "csv" in self.output_formats:
+            with open(filename, 'w') as csvfile:
+                print("Writing to {0}\n".format(filename))
+                writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+                writer.writerow(class_names)
+
+        if "npy" in self.output_formats:
+            filename = splitext(filename)[0] + ".npy"
             print("Writing to {0}\n".format(filename))
-            writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-            class_names = sorted(self.timings, key=natural_sort_keys)
-            writer.writerow(class_names)
-            self._write_class_names = class_names
+            self._timing_npy = NpyWriter(
+                filename, [(i, "<f8") for i in class_names])
 
     def _write_csv(self):
-        filename = join(self.output, self.write_csv)
-        with open(filename, 'a') as csvfile:
-            writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+        if "csv" in self.output_formats:
+            filename = join(self.output, self.write_csv)
+            with open(filename, 'a') as csvfile:
+                writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+                for values in zip(*[self.timings[i] for i in
+                        self._write_class_names]):
+                    writer.writerow(
+                        "{0:.9e}".format(float(i)) for i in values)
+
+        if self._timing_npy:
             for values in zip(*[self.timings[i] for i in
                     self._write_class_names]):
-                writer.writerow("{0:.9e}".format(float(i)) for i in values)
+                self._timing_npy.write(tuple(float(i) for i in values))
+
+        for i in self.timings.values():
+            i.clear()
 
-            for i in self.timings.values():
-                i.clear()
+    def _write_timing_columns(self, columns):
+        """
+        Write the times of all classes in large blocks.
+
+        :param list columns: arrays with times, in the same order as the
+            header of the timing file, only complete rows are written
+        """
+        rows = min(len(i) for i in columns) if columns else 0
+        filename = join(self.output, self.write_csv)
+
+        for start in range(0, rows, TIMING_BLOCK_SIZE):
+            block = np.stack(
+                [i[start:start + TIMING_BLOCK_SIZE] for i in columns],
+                axis=1)
+
+            if "csv" in self.output_formats:
+                with open(filename, 'a') as csvfile:
+                    np.savetxt(csvfile, block, fmt="%.9e", delimiter=",",
+                               newline="\r\n")
+
+            if self._timing_npy:
+                self._timing_npy.write_array(
+                    np.ascontiguousarray(block).view(
+                        self._timing_npy.dtype)[:, 0])
+
+    def _close_timing_files(self):
+        """Write out the buffered timing.npy rows."""
+        if self._timing_npy:
+            self._timing_npy.close()
+            self._timing_npy = None
 
     def _write_pkts(self):
         for _, _, _, clnt_msgs, clnt_msgs_acks, srv_msgs, srv_msgs_acks, _, _, _ in self.pckt_times:
@@ -970,16 +1750,60 @@ class Extract:
                 yield data
 
     def _divide_by_frequency(self, value_iter):
-        """Iterator. Devides value for given iter by frequency."""
+        """
+        Iterator. Devides value for given iter by frequency, after
+        subtracting the timer overhead.
+        """
         for value in value_iter:
-            yield value / self.frequency
+            yield (value - self.timer_overhead) / self.frequency
+
+    def _read_binary_times(self, column=0):
+        """
+        Memory-map the binary raw times file as an array of integers.
+
+        With counters, every time in the file is followed by the values of
+        the counters, column selects the times (0) or one of the counters
+        (1 and up).
+
+        Returns None if the size of the numbers doesn't match any numpy
+        integer type. Raises ValueError if the file ends with an
+        incomplete record.
+        """
+        if self.binary not in (1, 2, 4, 8):
+            return None
+
+        dtype = np.dtype("u{0}".format(self.binary)).newbyteorder(
+            "<" if self.endian == "little" else ">")
+        columns = 1 + len(self.counters)
+        count, left_over = divmod(getsize(self.raw_times),
+                                  self.binary * columns)
+        if left_over:
+            raise ValueError(
+                "Size of {0} is not a multiple of the record size "
+                "({1} bytes); truncated file or wrong counters?".format(
+                    self.raw_times, self.binary * columns))
+        if not count:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.raw_times, dtype=dtype, mode="r",
+                         shape=(count, columns))[:, column]
+
+    def _get_binary_times(self, times):
+        """Iterator. Return the times from the array, in chunks."""
+        for start in range(0, len(times), TIMING_BLOCK_SIZE):
+            chunk = times[start:start + TIMING_BLOCK_SIZE]
+            if self.frequency:
+                chunk = self._scale_times(chunk)
+            for value in chunk.tolist():
+                yield value
 
     def _get_time_from_file(self, filename=None):
         """Iterator. Read the times from file provided"""
         if self.binary:
+            times = self._read_binary_times()
+            if times is not None:
+                return self._get_binary_times(times)
             times_iter = self._get_data_from_binary_file(
-                self.raw_times, filename if filename else self.binary,
-                convert_to_int=True
+                self.raw_times, self.binary, convert_to_int=True
             )
         else:
             times_iter = self._get_data_from_csv_file(
@@ -1734,13 +2558,9 @@ class Extract:
 
     def process_rsa_keys(self):
         # list of values for the Hamming weight of d, p, q, dP, dQ, qInv
-        values = []
-        times = []
-        max_len = 20
-
-        tuple_num = 0
-
         value_names = ('d', 'p', 'q', 'dP', 'dQ', 'qInv')
+        values = dict((i, []) for i in value_names)
+        times = []
 
         rsa_keys = None
         measurements = dict((i, None) for i in value_names)
@@ -1750,42 +2570,34 @@ class Extract:
         try:
             rsa_keys = open(self.rsa_keys, "rt")
             for i in value_names:
-                f_name = join(self.output, 'measurements-' + i + '.csv')
-                measurements[i] = open(f_name, 'wt')
+                measurements[i] = MeasurementsWriter(
+                    join(self.output, 'measurements-' + i),
+                    self.output_formats)
+
+            tuples = TupleSelector(measurements, self.tuple_size,
+                                   self.value_bins, self.bin_method)
 
             while True:
                 # read an RSA private key
                 key = self._read_private_key(rsa_keys)
                 if key:
                     # extract Hamming weights of the private key parameters
-                    values.append(dict((i, bit_count(getattr(key, i)))
-                                       for i in
-                                       value_names))
+                    for i in value_names:
+                        values[i].append(bit_count(getattr(key, i)))
                     times.append(next(times_iterator))
 
-                # once we have few measurements collect them into tuples
+                # once we have enough measurements collect them into tuples
                 # and write to files
-                if len(values) >= max_len or (not key and times):
-                    for v_n in value_names:
-                        keys = set(v[v_n] for v in values)
-                        size_and_time = sorted(zip(
-                            (v[v_n] for v in values), times))
-
-                        for k in sorted(keys):
-                            to_select = [i for i in size_and_time if i[0] == k]
-                            # since sometimes for the same key we can have
-                            # multiple values, write a randomly selected one
-                            selected = choice(to_select)
-                            measurements[v_n].write("{0},{1},{2}\n".format(
-                                tuple_num, selected[0], selected[1]))
-
-                    values = []
+                if len(times) >= TIMING_BLOCK_SIZE or (not key and times):
+                    tuples.add(values, times)
+                    values = dict((i, []) for i in value_names)
                     times = []
-                    tuple_num += 1
 
                 if not key:
                     break
 
+            tuples.close()
+
         finally:
             if rsa_keys:
                 rsa_keys.close()
@@ -1826,13 +2638,32 @@ class Extract:
 
         return self._parse_pem_ml_kem_key(one_pem_key)
 
-    def _ml_kem_k_pke_decrypt_with_intermediates(self, kem, dk_pke, c, values):
+    def _read_ml_kem_keys(self):
+        """Read and prepare all the keys from the ML-KEM keys file."""
+        keys = []
+        with open(self.ml_kem_keys, "rt") as ml_kem_keys:
+            while True:
+                key = self._read_ml_kem_key(ml_kem_keys)
+                if not key:
+                    break
+                keys.append(PreparedKey(*key))
+
+        if not keys:
+            raise ValueError("No keys in the ML-KEM keys file!")
+        parameters = set((i.kem.k, i.kem.du, i.kem.dv) for i in keys)
+        if len(parameters) > 1:
+            raise ValueError("ML-KEM keys of different parameter sets in "
+                             "the keys file!")
+        return keys
+
+    def _ml_kem_k_pke_decrypt_with_intermediates(self, key, c, values):
+        kem = key.kem
         n = kem.k * kem.du * 32
         c1, c2 = c[:n], c[n:]
 
         u = kem.M.decode_vector(c1, kem.k, kem.du).decompress(kem.du)
         v = kem.R.decode(c2, kem.dv).decompress(kem.dv)
-        s_hat = kem.M.decode_vector(dk_pke, kem.k, 12, is_ntt=True)
+        s_hat = key.s_hat
 
         u_hat = u.to_ntt()
         s_hat_dot_u_hat = s_hat.dot(u_hat)
@@ -1853,34 +2684,56 @@ class Extract:
 
         return m
 
-    def _ml_kem_decaps_with_intermediates(self, kem, dk, c):
+    def _ml_kem_k_pke_encrypt(self, key, m, r):
+        """
+        K-PKE encryption, as in kyber-py, but using the already decoded
+        encryption key and expanded matrix from the prepared key.
+        """
+        kem = key.kem
+
+        N = 0
+        y, N = kem._generate_error_vector(r, kem.eta_1, N)
+        e1, N = kem._generate_error_vector(r, kem.eta_2, N)
+        e2, N = kem._generate_polynomial(r, kem.eta_2, N)
+
+        y_hat = y.to_ntt()
+
+        u = (key.a_hat_t @ y_hat).from_ntt() + e1
+
+        mu = kem.R.decode(m, 1).decompress(1)
+        v = key.t_hat.dot(y_hat).from_ntt() + e2 + mu
+
+        c1 = u.compress(kem.du).encode(kem.du)
+        c2 = v.compress(kem.dv).encode(kem.dv)
+
+        return c1 + c2
+
+    def _ml_kem_decaps_with_intermediates(self, key, c):
         """
         Perform ML-KEM decapsulation, return also metadata about intermediate
         values of the algorithm.
+
+        Reference implementation of the ml_kem_decaps_batch() calculations,
+        it processes one ciphertext at a time.
         """
         values = dict()
+        kem = key.kem
 
         if len(c) != 32 * (kem.du * kem.k + kem.dv):
             raise ValueError("wrong ciphertext length")
-        if len(dk) != kem._dk_size():
-            raise ValueError("wrong decapsulation key length")
 
-        dk_pke = dk[0:384 * kem.k]
-        ek_pke = dk[384 * kem.k : 768 * kem.k + 32]
-        h = dk[768 * kem.k + 32 : 768 * kem.k + 64]
-        z = dk[768 * kem.k + 64 :]
         m_prime = self._ml_kem_k_pke_decrypt_with_intermediates(
-            kem, dk_pke, c, values)
+            key, c, values)
 
         values['hw-m-prime'] = bit_count(bytesToNumber(m_prime))
 
-        K_prime, r_prime = kem._G(m_prime + h)
+        K_prime, r_prime = kem._G(m_prime + key.h)
 
         values['hw-r-prime'] = bit_count(bytesToNumber(r_prime))
 
-        K_bar = kem._J(z + c)
+        K_bar = kem._J(key.z + c)
 
-        c_prime = kem._k_pke_encrypt(ek_pke, m_prime, r_prime)
+        c_prime = self._ml_kem_k_pke_encrypt(key, m_prime, r_prime)
 
         values['hw-c-prime'] = bit_count(bytesToNumber(c_prime))
 
@@ -1903,83 +2756,580 @@ class Extract:
         else:
             return K_bar, values
 
-    def process_ml_kem_keys(self):
-        # list of values for the summary statistics of intermediate values
-        values = []
-        times = []
-        max_len = 20
+    def _ml_kem_process_chunk(self, keys, offset, c, side_data, key_index):
+        """
+        Calculate the intermediate values for the ciphertexts c, the first
+        of them being the ciphertext number offset in the ciphertexts file.
 
-        tuple_num = 0
+        keys is the list of prepared keys, key_index the index of the key
+        of every ciphertext, or None if there's just one key. Ciphertexts
+        of every key are decapsulated together.
 
-        value_names = ('hw-m-prime', 'hw-r-prime', 'hw-w', 'bit-size-w',
-                       'hw-s-hat-dot-u-hat', 'bit-size-s-hat-dot-u-hat',
-                       'bit-size-min-w', 'hw-c-prime', 'hd-c-c-prime',
-                       'first-diff-c-c-prime', 'last-diff-c-c-prime')
+        If side data is available, check that the shared secrets of the
+        valid ciphertexts are the expected ones.
+        """
+        if key_index is None:
+            groups = [(keys[0], np.arange(len(c)))]
+        else:
+            unknown = key_index >= len(keys)
+            if unknown.any():
+                raise ValueError(
+                    "No key with index {0} for ciphertext {1}".format(
+                        int(key_index[unknown.argmax()]),
+                        offset + int(unknown.argmax())))
+            groups = [(keys[i], np.flatnonzero(key_index == i))
+                      for i in np.unique(key_index)]
+
+        values = {}
+        for key, rows in groups:
+            group_side_data = None
+            if side_data is not None:
+                group_side_data = side_data[rows]
+
+            shared_secrets, group_values = ml_kem_decaps_batch(
+                key, c[rows], group_side_data, self.ml_kem_values)
+
+            if side_data is not None:
+                known = (group_side_data["flags"] & SIDE_DATA_KNOWN) != 0
+                mismatch = known & \
+                    (shared_secrets != group_side_data["K"]).any(axis=1)
+                if mismatch.any():
+                    raise ValueError(
+                        "Unexpected shared secret for ciphertext {0}".format(
+                            offset + int(rows[mismatch.argmax()])))
 
-        ml_kem_keys = None
-        ciphertexts = None
-        measurements = dict((i, None) for i in value_names)
+            for name, group_value in group_values.items():
+                if name not in values:
+                    values[name] = np.empty(len(c), dtype=group_value.dtype)
+                values[name][rows] = group_value
 
-        times_iterator = self._get_time_from_file()
+        return values
 
-        try:
-            ml_kem_keys = open(self.ml_kem_keys, "rt")
-            for i in value_names:
-                f_name = join(self.output, f"measurements-{i}.csv")
-                measurements[i] = open(f_name, "wt")
+    def _ml_kem_open_inputs(self, kem):
+        """
+        Memory map the ciphertexts file and, if set, the side data and the
+        key index files.
 
-            kem, key = self._read_ml_kem_key(ml_kem_keys)
+        Returns the CiphertextFile and the arrays of side data records and
+        key indexes, None for the files that are not set.
+        """
+        value_size = 32 * (kem.du * kem.k + kem.dv)
 
-            value_size = 32 * (kem.du * kem.k + kem.dv)
+        ciphertexts = CiphertextFile(self.values, value_size)
 
-            ciphertexts = open(self.values, "rb")
+        side_data = None
+        if self.ml_kem_side_data:
+            side_data = read_side_data(self.ml_kem_side_data)
+            if len(side_data) != len(ciphertexts):
+                raise ValueError(
+                    "Side data doesn't match the ciphertexts file "
+                    "(expected: {0} records, found: {1})".format(
+                        len(ciphertexts), len(side_data)))
+
+        key_index = None
+        if self.ml_kem_key_index:
+            key_index = read_key_index(self.ml_kem_key_index)
+            if len(key_index) != len(ciphertexts):
+                raise ValueError(
+                    "Key index doesn't match the ciphertexts file "
+                    "(expected: {0} entries, found: {1})".format(
+                        len(ciphertexts), len(key_index)))
 
-            while True:
-                ciphertext = ciphertexts.read(value_size)
+        return ciphertexts, side_data, key_index
 
-                if ciphertext:
+    def _ml_kem_process_range(self, keys, inputs, offset, end):
+        """
+        Calculate intermediate values of the ciphertexts from offset to
+        end, taken from the memory-mapped inputs returned by
+        _ml_kem_open_inputs().
+        """
+        ciphertexts, side_data, key_index = inputs
+        if side_data is not None:
+            side_data = side_data[offset:end]
+        if key_index is not None:
+            key_index = key_index[offset:end]
+        return self._ml_kem_process_chunk(
+            keys, offset, ciphertexts.array[offset:end], side_data,
+            key_index)
+
+    def _ml_kem_read_chunks(self, ciphertexts_count, times, start,
+                            out_queue, stop, status, errors):
+        """
+        Pipeline stage. Read the times of chunks of ciphertexts and queue
+        the chunks for decapsulation.
 
-                    ss, v = self._ml_kem_decaps_with_intermediates(
-                        kem, key, ciphertext)
+        Only the positions of the ciphertexts are queued, the
+        decapsulation stage takes them from the memory-mapped files.
+        """
+        try:
+            for offset in range(start, ciphertexts_count,
+                                ML_KEM_CHUNK_SIZE):
+                if stop.is_set():
+                    break
+                end = min(offset + ML_KEM_CHUNK_SIZE, ciphertexts_count)
+                chunk_times = np.array(times[offset:end])
+                if self.frequency:
+                    chunk_times = self._scale_times(chunk_times)
+                out_queue.put((offset, end, chunk_times))
+                status[0] = end
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            out_queue.put(None)
 
-                    # TODO compare the the gotten shared secret with the
-                    # expected value
+    def _ml_kem_decaps_chunks(self, keys, inputs, in_queue):
+        """
+        Iterator. Pipeline stage. Yields the offsets, intermediate values
+        and times of the chunks read from in_queue, in the same order.
+
+        Unless a single worker was requested, the chunks are processed in
+        parallel by a pool of worker processes, with at most two chunks per
+        worker being processed or waiting for the next stage at a time.
+        The workers map the input files themselves, they receive only the
+        positions of the ciphertexts.
+        """
+        if self.workers == 1:
+            for offset, end, times in _queue_iter(in_queue):
+                yield offset, self._ml_kem_process_range(
+                    keys, inputs, offset, end), times
+            return
 
-                    values.append(v)
-                    times.append(next(times_iterator))
+        window = 2 * (self.workers or mp.cpu_count())
+        with mp.Pool(self.workers, initializer=_ml_kem_worker_init,
+                     initargs=(self.ml_kem_keys, self.ml_kem_values,
+                               self.values, self.ml_kem_side_data,
+                               self.ml_kem_key_index)) as pool:
+            pending = deque()
+            for offset, end, times in _queue_iter(in_queue):
+                pending.append((offset, pool.apply_async(
+                    _ml_kem_worker_process_chunk, ((offset, end),)), times))
+                if len(pending) >= window:
+                    offset, result, times = pending.popleft()
+                    yield offset, result.get(), times
+            while pending:
+                offset, result, times = pending.popleft()
+                yield offset, result.get(), times
+
+    def _ml_kem_write_chunks(self, tuples, in_queue, status, errors,
+                             checkpoint, cache):
+        """
+        Pipeline stage. Create tuples from values and write them.
 
-                # if we didn't read a new ciphertext we still need to dump
-                # the values to files
-                if len(values) >= max_len or (not ciphertext and times):
-                    for v_n in value_names:
-                        keys = set(v[v_n] for v in values)
-                        size_and_time = sorted(zip(
-                            (v[v_n] for v in values), times))
-
-                        for k in sorted(keys):
-                            to_select = [i for i in size_and_time if i[0] == k]
-                            # since sometimes for the same key we can have
-                            # multiple values, write a randomly selected one
-                            selected = choice(to_select)
-                            measurements[v_n].write("{0},{1},{2}\n".format(
-                                tuple_num, selected[0], selected[1]))
-
-                    values = []
-                    times = []
-                    tuple_num += 1
+        Calls checkpoint, if set, every ML_KEM_CHECKPOINT_INTERVAL seconds.
+        Values of the ciphertexts not yet in cache, if set, are added to it.
+        """
+        try:
+            last_checkpoint = time.time()
+            for offset, values, times in _queue_iter(in_queue):
+                if errors:
+                    continue
+                tuples.add(values, times)
+                if cache:
+                    self._ml_kem_cache_values(cache, offset, values)
+                status[0] += len(times)
+                if checkpoint and \
+                        time.time() - last_checkpoint >= \
+                        ML_KEM_CHECKPOINT_INTERVAL:
+                    checkpoint()
+                    last_checkpoint = time.time()
+            if not errors:
+                tuples.close()
+        except BaseException as e:
+            errors.append(e)
+            # let the other stages finish
+            for _ in _queue_iter(in_queue):
+                pass
 
-                if not ciphertext:
+    def _ml_kem_pipeline(self, keys, inputs, times, tuples, start=0,
+                         checkpoint=None, cache=None):
+        """
+        Decapsulate the ciphertexts and write the measurements.
+
+        Reading of the times, decapsulation and writing of the
+        measurements run in parallel, connected by bounded queues, so
+        the memory use doesn't depend on the number of ciphertexts.
+
+        inputs are the memory-mapped files returned by
+        _ml_kem_open_inputs(). Processing starts with the ciphertext
+        number start, checkpoint is a function periodically called by the
+        writer, cache is the NpyWriter of the values cache.
+        """
+        total = len(inputs[0])
+        stages = (("read", [start, total, Event()]),
+                  ("decapsulated", [start, total, Event()]),
+                  ("written", [start, total, Event()]))
+        read_status, decaps_status, write_status = (i[1] for i in stages)
+
+        progress = []
+        if self.verbose:
+            kwargs = {}
+            kwargs['unit'] = ' ciphertexts'
+            kwargs['delay'] = self.delay
+            kwargs['end'] = self.carriage_return
+            progress.append(Thread(target=_stages_progress_report,
+                                   args=(stages,), kwargs=kwargs))
+            progress[-1].start()
+
+        errors = []
+        stop = Event()
+        read_queue = queue.Queue(ML_KEM_QUEUE_SIZE)
+        write_queue = queue.Queue(ML_KEM_QUEUE_SIZE)
+        reader = Thread(target=self._ml_kem_read_chunks,
+                        args=(total, times, start, read_queue, stop,
+                              read_status, errors))
+        writer = Thread(target=self._ml_kem_write_chunks,
+                        args=(tuples, write_queue, write_status, errors,
+                              checkpoint, cache))
+        reader.start()
+        writer.start()
+        chunks = self._ml_kem_decaps_chunks(keys, inputs, read_queue)
+        try:
+            for offset, values, chunk_times in chunks:
+                write_queue.put((offset, values, chunk_times))
+                decaps_status[0] += len(chunk_times)
+                if errors:
                     break
+        finally:
+            chunks.close()
+            stop.set()
+            # unblock the reader if it waits for space in the queue
+            while reader.is_alive():
+                try:
+                    read_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            write_queue.put(None)
+            reader.join()
+            writer.join()
+            for _, status in stages:
+                status[2].set()
+            for i in progress:
+                i.join()
+            if progress:
+                print()
+
+        if errors:
+            raise errors[0]
+
+    def _ml_kem_pair_cached_values(self, cached_values, times, tuples,
+                                   start=0):
+        """
+        Write the measurements with the values read from the values cache,
+        starting with the ciphertext number start.
+        """
+        total = len(cached_values)
+        status = [start, total, Event()]
+        progress = None
+        if self.verbose:
+            kwargs = {}
+            kwargs['unit'] = ' values paired'
+            kwargs['prefix'] = 'decimal'
+            kwargs['delay'] = self.delay
+            kwargs['end'] = self.carriage_return
+            progress = Thread(target=progress_report, args=(status,),
+                              kwargs=kwargs)
+            progress.start()
+
+        try:
+            for offset in range(start, total, TIMING_BLOCK_SIZE):
+                end = min(offset + TIMING_BLOCK_SIZE, total)
+                chunk = np.array(cached_values[offset:end])
+                chunk_times = np.array(times[offset:end])
+                if self.frequency:
+                    chunk_times = self._scale_times(chunk_times)
+                tuples.add(dict((name, chunk[name].astype(np.int64))
+                                for name in chunk.dtype.names),
+                           chunk_times)
+                status[0] = end
+            tuples.close()
+        finally:
+            status[2].set()
+            if progress:
+                progress.join()
+                print()
+
+    def _ml_kem_cache_name(self, value_names):
+        """
+        Return the name of the values cache for the ciphertexts, the keys,
+        the key index and the values to extract.
+        """
+        digest = hashlib.sha256()
+        for filename in (self.values, self.ml_kem_keys,
+                         self.ml_kem_key_index):
+            if filename is None:
+                continue
+            file_digest = hashlib.sha256()
+            with open(filename, "rb") as in_fp:
+                for block in iter(lambda: in_fp.read(HASH_BLOCK_SIZE), b""):
+                    file_digest.update(block)
+            digest.update(file_digest.digest())
+        digest.update(",".join(sorted(value_names)).encode("ascii"))
+        return join(self.output,
+                    ML_KEM_CACHE.format(digest.hexdigest()[:32]))
+
+    @staticmethod
+    def _ml_kem_cache_dtype(value_names):
+        """Return the dtype of the rows of the values cache."""
+        return np.dtype([(name, ML_KEM_METRICS[name][2])
+                         for name in sorted(value_names)])
+
+    @staticmethod
+    def _ml_kem_cache_values(cache, offset, values):
+        """
+        Add values of the ciphertexts starting with the ciphertext number
+        offset to the values cache, skipping those already in it.
+        """
+        skip = cache.count - offset
+        if skip < 0:
+            raise ValueError("Values of ciphertexts {0} to {1} missing from "
+                             "the values cache".format(cache.count, offset))
+        count = len(next(iter(values.values())))
+        if skip >= count:
+            return
+
+        data = np.empty(count - skip, dtype=cache.dtype)
+        for name in cache.dtype.names:
+            data[name] = values[name][skip:]
+            if (data[name] != values[name][skip:]).any():
+                raise ValueError(
+                    "Values of {0} don't fit in {1}".format(
+                        name, cache.dtype[name]))
+        cache.write_array(data)
+
+    def _ml_kem_parameters(self, value_names):
+        """Return the parameters that must not change when resuming."""
+        return {"ml_kem_keys": self.ml_kem_keys,
+                "ciphertexts": self.values,
+                "ciphertexts_size": getsize(self.values),
+                "side_data": self.ml_kem_side_data,
+                "key_index": self.ml_kem_key_index,
+                "raw_times": self.raw_times,
+                "sample_info": self.sample_info,
+                "canary_times": self.canary_times,
+                "max_disturbances": self.max_disturbances,
+                "canary_limit": self.canary_limit,
+                "counters": list(self.counters),
+                "binary": self.binary,
+                "endian": self.endian,
+                "col_name": self.col_name,
+                "frequency": self.frequency,
+                "timer_overhead": self.timer_overhead,
+                "values": list(value_names),
+                "tuple_size": self.tuple_size,
+                "value_bins": self.value_bins,
+                "bin_method": self.bin_method,
+                "ml_kem_cache": self.ml_kem_cache,
+                "output_formats": list(self.output_formats)}
+
+    def _ml_kem_write_checkpoint(self, parameters, tuples, measurements,
+                                 cache=None):
+        """Record the state of the extraction after the written tuples."""
+        checkpoint = tuples.get_state()
+        checkpoint["parameters"] = parameters
+        checkpoint["files"] = dict((name, writer.flush())
+                                   for name, writer in measurements.items())
+        if cache:
+            checkpoint["cache"] = cache.size()
+
+        filename = join(self.output, ML_KEM_CHECKPOINT)
+        with open(filename + ".tmp", "w") as checkpoint_fp:
+            json.dump(checkpoint, checkpoint_fp)
+        replace(filename + ".tmp", filename)
+
+    def _ml_kem_read_checkpoint(self, parameters):
+        """Return the last checkpoint, None if there is none."""
+        filename = join(self.output, ML_KEM_CHECKPOINT)
+        if not exists(filename):
+            print("No checkpoint found, starting from the beginning")
+            return None
+
+        with open(filename, "r") as checkpoint_fp:
+            checkpoint = json.load(checkpoint_fp)
+
+        if checkpoint["parameters"] != parameters:
+            raise ValueError(
+                "The checkpoint {0} was created with different ".format(
+                    filename) +
+                "parameters or input files, can't resume.")
+
+        print("Resuming from ciphertext {0}".format(checkpoint["written"]))
+        return checkpoint
+
+    def process_ml_kem_keys(self):
+        value_names = self.ml_kem_values
+        if value_names is None:
+            value_names = tuple(ML_KEM_METRICS)
+
+        cache = None
+        measurements = dict((i, None) for i in value_names)
+
+        parameters = self._ml_kem_parameters(value_names)
+        checkpoint = None
+        if self.resume:
+            checkpoint = self._ml_kem_read_checkpoint(parameters)
+
+        cache_name = None
+        if self.ml_kem_cache:
+            cache_name = self._ml_kem_cache_name(value_names)
+
+        if not checkpoint:
+            # the files are written from the start, an interrupted
+            # extraction must not resume from an older checkpoint
+            checkpoint_name = join(self.output, ML_KEM_CHECKPOINT)
+            for filename in (checkpoint_name, checkpoint_name + ".tmp",
+                             cache_name and cache_name + ".tmp"):
+                if filename and exists(filename):
+                    remove(filename)
+
+        try:
+            for i in value_names:
+                measurements[i] = MeasurementsWriter(
+                    join(self.output, f"measurements-{i}"),
+                    self.output_formats,
+                    checkpoint and checkpoint["files"][i])
+
+            keys = self._read_ml_kem_keys()
+            kem = keys[0].kem
+
+            inputs = self._ml_kem_open_inputs(kem)
+            ciphertexts = inputs[0]
+
+            if not self.ml_kem_key_index and len(keys) > 1:
+                raise ValueError(
+                    "Key index file required with multiple ML-KEM keys.")
+
+            # the times are scaled chunk by chunk, so that memory-mapped
+            # files don't have to be read into memory
+            times = self._read_times_array(scale=False)
+            if len(times) < len(ciphertexts):
+                raise ValueError(
+                    "Insufficient number of times for the ciphertexts "
+                    "(expected: {0}, found: {1})".format(
+                        len(ciphertexts), len(times)))
+
+            disturbed = self._disturbed_samples(len(times))
+            if disturbed is not None:
+                # TupleSelector skips the samples with NaN times
+                times = np.where(disturbed, np.nan, times)
+
+            tuples = TupleSelector(measurements, self.tuple_size,
+                                   self.value_bins, self.bin_method)
+
+            start = 0
+            if checkpoint:
+                tuples.set_state(checkpoint)
+                start = tuples.written
+
+            cached_values = None
+            if cache_name and exists(cache_name):
+                cached_values = np.load(cache_name, mmap_mode="r")
+                if len(cached_values) != len(ciphertexts):
+                    print("Ignoring values cache {0} not matching the "
+                          "ciphertexts".format(cache_name))
+                    cached_values = None
+
+            if cached_values is not None:
+                print("Using values cache {0}".format(cache_name))
+                self._ml_kem_pair_cached_values(cached_values, times,
+                                                tuples, start)
+            else:
+                # a resumed extraction continues the values cache only if
+                # the interrupted one was creating it
+                if cache_name and (not checkpoint or "cache" in checkpoint):
+                    cache = NpyWriter(
+                        cache_name + ".tmp",
+                        self._ml_kem_cache_dtype(value_names),
+                        size=checkpoint and checkpoint["cache"])
+
+                # tuples of binned values are created only at the end
+                write_checkpoint = None if self.value_bins else partial(
+                    self._ml_kem_write_checkpoint, parameters, tuples,
+                    measurements, cache)
+
+                self._ml_kem_pipeline(keys, inputs, times, tuples, start,
+                                      write_checkpoint, cache)
+
+                if cache:
+                    cache.close()
+                    replace(cache_name + ".tmp", cache_name)
+
+            # the extraction is complete
+            if exists(join(self.output, ML_KEM_CHECKPOINT)):
+                remove(join(self.output, ML_KEM_CHECKPOINT))
 
         finally:
-            if ml_kem_keys:
-                ml_kem_keys.close()
-            if ciphertexts:
-                ciphertexts.close()
+            if cache:
+                cache.close()
 
             for i in value_names:
                 if measurements[i]:
                     measurements[i].close()
 
+
+# state of the ML-KEM worker processes, set up by _ml_kem_worker_init()
+_ml_kem_worker = {}
+
+
+def _ml_kem_worker_init(ml_kem_keys, ml_kem_values, values,
+                        ml_kem_side_data, ml_kem_key_index):
+    """Prepare the keys and map the input files in a worker process."""
+    extract = Extract(ml_kem_keys=ml_kem_keys, ml_kem_values=ml_kem_values,
+                      values=values, ml_kem_side_data=ml_kem_side_data,
+                      ml_kem_key_index=ml_kem_key_index)
+    keys = extract._read_ml_kem_keys()
+
+    _ml_kem_worker["extract"] = extract
+    _ml_kem_worker["keys"] = keys
+    _ml_kem_worker["inputs"] = extract._ml_kem_open_inputs(keys[0].kem)
+
+
+def _ml_kem_worker_process_chunk(chunk):
+    """Calculate intermediate values of the ciphertexts from offset to end."""
+    offset, end = chunk
+    return _ml_kem_worker["extract"]._ml_kem_process_range(
+        _ml_kem_worker["keys"], _ml_kem_worker["inputs"], offset, end)
+
+
+def _stages_progress_report(stages, unit="", delay=None, end=None):
+    """
+    Print the progress of the stages of a pipeline on a single line, every
+    delay seconds, until the last stage is finished.
+
+    stages is a sequence of (name, status) pairs, with status as for
+    progress_report(): the number of processed items, the total number
+    of items and an Event set when the stage is finished.
+    """
+    if delay is None:
+        delay = 2.0
+    if end is None:
+        end = "\r"
+    last = stages[-1][1]
+    start_time = time.time()
+    start_done = last[0]
+    while True:
+        finished = last[2].wait(delay)
+        elapsed = time.time() - start_time
+        speed = (last[0] - start_done) / elapsed if elapsed else 0
+        print(", ".join(
+                  "{0}: {1:6.2f}%".format(
+                      name, 100.0 * status[0] / status[1] if status[1]
+                      else 100.0)
+                  for name, status in stages) +
+              ", elapsed: {0:.2f}s, speed: {1:.2f}{2}/s ".format(
+                  elapsed, speed, unit),
+              end=end)
+        if finished:
+            return
+
+
+def _queue_iter(in_queue):
+    """Iterator. Return items from the queue until None is received."""
+    while True:
+        item = in_queue.get()
+        if item is None:
+            return
+        yield item
+
+
 if __name__ == '__main__':
     main()
@@ -1,22 +1,95 @@
+#define _GNU_SOURCE
 #include <memory.h>
 #include <string.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <unistd.h>
 #include <fcntl.h>
+#include <endian.h>
+#include <inttypes.h>
+#include <time.h>
+#include <sys/stat.h>
+#include <sys/syscall.h>
+#include <sys/resource.h>
+#include <linux/perf_event.h>
 
 #include <openssl/err.h>
 #include <openssl/evp.h>
 #include <openssl/rsa.h>
 #include <openssl/pem.h>
 
+/* number of measurements of the clock frequency, each CALIBRATION_NS long,
+ * the median one is reported */
+#define CALIBRATION_ROUNDS 5
+#define CALIBRATION_NS 100000000
+/* number of measurements of an empty timed region */
+#define OVERHEAD_SAMPLES 100000
+/* maximum number of hardware counters measured with -e */
+#define MAX_COUNTERS 4
+
+/* hardware counters supported by -e, with their perf_event_open() type and
+ * config
+ */
+struct counter_type {
+    const char *name;
+    uint32_t type;
+    uint64_t config;
+};
+
+static const struct counter_type counter_types[] = {
+    {"cycles", PERF_TYPE_HARDWARE, PERF_COUNT_HW_CPU_CYCLES},
+    {"instructions", PERF_TYPE_HARDWARE, PERF_COUNT_HW_INSTRUCTIONS},
+    {"branch-misses", PERF_TYPE_HARDWARE, PERF_COUNT_HW_BRANCH_MISSES},
+    {"l1d-misses", PERF_TYPE_HW_CACHE, PERF_COUNT_HW_CACHE_L1D |
+        (PERF_COUNT_HW_CACHE_OP_READ << 8) |
+        (PERF_COUNT_HW_CACHE_RESULT_MISS << 16)},
+    {NULL, 0, 0}
+};
+
 void help(char *name) {
-    printf("Usage: %s -i file -o file -k file -n num [-h]\n", name);
+    printf("Usage: %s -i file -o file -k file -n num [-x file] [-b] [-m file]\n", name);
+    printf("       [-w num] [-s file] [-c num -C file] [-a num | -l file -A class]\n");
+    printf("       [-e list] [-h]\n");
     printf("\n");
     printf(" -i file    File with concatenated ciphertexts to decrypt\n");
     printf(" -o file    File where to write the time to decrypt the ciphertext\n");
-    printf(" -k file    File with the RSA private key in PEM format\n");
+    printf(" -k file    File with the private key in PEM format, or concatenated\n");
+    printf("            private keys when used with -x\n");
     printf(" -n num     Length of individual ciphertexts in bytes\n");
+    printf(" -x file    Key index file: little-endian 16 bit position of the key\n");
+    printf("            in the -k file for every ciphertext\n");
+    printf(" -b         Batch mode: read all the ciphertexts into memory before\n");
+    printf("            the measurements and write the times only after all of them\n");
+    printf(" -m file    Calibrate the clock frequency against CLOCK_MONOTONIC_RAW\n");
+    printf("            and measure the overhead of the time measurement, write\n");
+    printf("            the results to file (extract.py --timer-metadata)\n");
+    printf(" -w num     Decapsulate num ciphertexts before the measurements,\n");
+    printf("            without recording the times. Batch mode only\n");
+    printf(" -s file    Write the sequence number and the number of context\n");
+    printf("            switches and CPU migrations during the measurement of\n");
+    printf("            every ciphertext to file, as two 8 byte little-endian\n");
+    printf("            integers (extract.py --sample-info). Costs a read() of\n");
+    printf("            the counters after every measurement, outside of the\n");
+    printf("            timed region, the disturbances since the previous\n");
+    printf("            measurement count too. Batch mode only\n");
+    printf(" -c num     Measure the canary ciphertext again before every num\n");
+    printf("            ciphertexts. Batch mode only\n");
+    printf(" -C file    File to write the sequence number, time and number of\n");
+    printf("            context switches and CPU migrations of every canary to,\n");
+    printf("            as three 8 byte little-endian integers\n");
+    printf("            (extract.py --canary-times)\n");
+    printf(" -a num     Position of the canary ciphertext in the -i file, the\n");
+    printf("            first ciphertext by default\n");
+    printf(" -l file    Log file with the classes of the ciphertexts (log.csv\n");
+    printf("            written by ml_kem_encap.py), to pick the canary with -A\n");
+    printf(" -A class   Use the first ciphertext of class as the canary, the name\n");
+    printf("            of the class in the -l file or the number of its column\n");
+    printf(" -e list    Comma separated list of hardware counters to measure\n");
+    printf("            in a second, untimed, decapsulation of every ciphertext\n");
+    printf("            (in batch mode after all the timed ones): cycles,\n");
+    printf("            instructions, branch-misses, l1d-misses. Their values are\n");
+    printf("            written to the -o file after every time, in the same\n");
+    printf("            order, as 8 byte integers (extract.py --counters)\n");
     printf(" -h         This message\n");
 }
 
@@ -119,21 +192,414 @@ uint64_t get_time_after() {
     return time_after;
 }
 
+int compare_uint64(const void *a, const void *b) {
+    uint64_t x = *(const uint64_t *)a, y = *(const uint64_t *)b;
+    return (x > y) - (x < y);
+}
+
+int compare_double(const void *a, const void *b) {
+    double x = *(const double *)a, y = *(const double *)b;
+    return (x > y) - (x < y);
+}
+
+uint64_t get_monotonic_raw_ns() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC_RAW, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+/* Return the frequency of the clock read by get_time_before() and
+ * get_time_after() in MHz, measured against CLOCK_MONOTONIC_RAW
+ */
+double calibrate_frequency() {
+    double rounds[CALIBRATION_ROUNDS];
+    uint64_t ns_before, ns_after, ticks_before, ticks_after;
+    struct timespec delay = {0, CALIBRATION_NS};
+    int i;
+
+    for (i = 0; i < CALIBRATION_ROUNDS; i++) {
+        ns_before = get_monotonic_raw_ns();
+        ticks_before = get_time_before();
+
+        nanosleep(&delay, NULL);
+
+        ticks_after = get_time_after();
+        ns_after = get_monotonic_raw_ns();
+
+        rounds[i] = (double)(ticks_after - ticks_before) * 1000 /
+                    (ns_after - ns_before);
+    }
+
+    qsort(rounds, CALIBRATION_ROUNDS, sizeof(*rounds), compare_double);
+    return rounds[CALIBRATION_ROUNDS / 2];
+}
+
+/* Calibrate the clock frequency, measure the distribution of times of an
+ * empty timed region and write both to a JSON file, return 0 on success
+ */
+int write_timer_metadata(const char *file_name) {
+    uint64_t *overhead, time_before, time_after;
+    double frequency, mean = 0;
+    FILE *fp;
+    int i;
+
+    overhead = malloc(OVERHEAD_SAMPLES * sizeof(*overhead));
+    if (!overhead)
+        return -1;
+
+    for (i = 0; i < OVERHEAD_SAMPLES; i++) {
+        time_before = get_time_before();
+        time_after = get_time_after();
+        overhead[i] = time_after - time_before;
+    }
+
+    qsort(overhead, OVERHEAD_SAMPLES, sizeof(*overhead), compare_uint64);
+    for (i = 0; i < OVERHEAD_SAMPLES; i++)
+        mean += overhead[i];
+    mean /= OVERHEAD_SAMPLES;
+
+    frequency = calibrate_frequency();
+
+    fp = fopen(file_name, "w");
+    if (!fp) {
+        fprintf(stderr, "can't open metadata file %s\n", file_name);
+        free(overhead);
+        return -1;
+    }
+
+    fprintf(fp, "{\n");
+    fprintf(fp, "    \"clock_frequency\": %.6f,\n", frequency);
+    fprintf(fp, "    \"overhead\": {\n");
+    fprintf(fp, "        \"samples\": %d,\n", OVERHEAD_SAMPLES);
+    fprintf(fp, "        \"mean\": %.3f,\n", mean);
+    fprintf(fp, "        \"min\": %" PRIu64 ",\n", overhead[0]);
+    fprintf(fp, "        \"p1\": %" PRIu64 ",\n",
+            overhead[OVERHEAD_SAMPLES / 100]);
+    fprintf(fp, "        \"p25\": %" PRIu64 ",\n",
+            overhead[OVERHEAD_SAMPLES / 4]);
+    fprintf(fp, "        \"median\": %" PRIu64 ",\n",
+            overhead[OVERHEAD_SAMPLES / 2]);
+    fprintf(fp, "        \"p75\": %" PRIu64 ",\n",
+            overhead[OVERHEAD_SAMPLES / 4 * 3]);
+    fprintf(fp, "        \"p99\": %" PRIu64 ",\n",
+            overhead[OVERHEAD_SAMPLES / 100 * 99]);
+    fprintf(fp, "        \"max\": %" PRIu64 "\n",
+            overhead[OVERHEAD_SAMPLES - 1]);
+    fprintf(fp, "    }\n");
+    fprintf(fp, "}\n");
+
+    fprintf(stderr, "Clock frequency: %.6f MHz, median overhead: %" PRIu64
+            " ticks\n", frequency, overhead[OVERHEAD_SAMPLES / 2]);
+
+    free(overhead);
+    if (fclose(fp) != 0)
+        return -1;
+    return 0;
+}
+
+/* Open the context switch and CPU migration counters of this thread as
+ * a group, the group leader is fds[0], return 0 on success
+ */
+int open_disturbance_counters(int fds[2]) {
+    struct perf_event_attr attr;
+
+    memset(&attr, 0, sizeof(attr));
+    attr.size = sizeof(attr);
+    attr.type = PERF_TYPE_SOFTWARE;
+    attr.config = PERF_COUNT_SW_CONTEXT_SWITCHES;
+    attr.read_format = PERF_FORMAT_GROUP;
+    fds[0] = syscall(SYS_perf_event_open, &attr, 0, -1, -1, 0);
+    if (fds[0] == -1)
+        return -1;
+
+    attr.config = PERF_COUNT_SW_CPU_MIGRATIONS;
+    fds[1] = syscall(SYS_perf_event_open, &attr, 0, -1, fds[0], 0);
+    if (fds[1] == -1) {
+        close(fds[0]);
+        fds[0] = -1;
+        return -1;
+    }
+    return 0;
+}
+
+/* Return the number of context switches and CPU migrations of this thread
+ * so far, from the counters group if it's open, otherwise only the
+ * context switches reported by getrusage()
+ */
+uint64_t read_disturbances(int perf_fd) {
+    uint64_t values[3] = {0, 0, 0};
+    struct rusage usage;
+
+    if (perf_fd >= 0) {
+        if (read(perf_fd, values, sizeof(values)) != sizeof(values))
+            return 0;
+        return values[1] + values[2];
+    }
+
+    getrusage(RUSAGE_THREAD, &usage);
+    return usage.ru_nvcsw + usage.ru_nivcsw;
+}
+
+/* Open the hardware counters listed in the comma separated names, as
+ * a group with fds[0] as the leader, counting only in user space, set
+ * count to the number of counters, return 0 on success
+ */
+int open_hardware_counters(char *names, int fds[MAX_COUNTERS],
+                           size_t *count) {
+    struct perf_event_attr attr;
+    const struct counter_type *counter;
+    char *name;
+
+    for (name = strtok(names, ","); name; name = strtok(NULL, ",")) {
+        for (counter = counter_types; counter->name; counter++)
+            if (strcmp(counter->name, name) == 0)
+                break;
+        if (!counter->name) {
+            fprintf(stderr, "Unknown counter: %s\n", name);
+            return -1;
+        }
+        if (*count == MAX_COUNTERS) {
+            fprintf(stderr, "At most %d counters supported\n", MAX_COUNTERS);
+            return -1;
+        }
+
+        memset(&attr, 0, sizeof(attr));
+        attr.size = sizeof(attr);
+        attr.type = counter->type;
+        attr.config = counter->config;
+        attr.read_format = PERF_FORMAT_GROUP;
+        attr.exclude_kernel = 1;
+        attr.exclude_hv = 1;
+        /* the group is scheduled on the CPU only as a whole */
+        attr.pinned = *count == 0;
+        fds[*count] = syscall(SYS_perf_event_open, &attr, 0, -1,
+                              *count ? fds[0] : -1, 0);
+        if (fds[*count] == -1) {
+            fprintf(stderr, "Can't open counter %s\n", name);
+            perror("perf_event_open");
+            return -1;
+        }
+        (*count)++;
+    }
+    return 0;
+}
+
+/* Set canary_index to the position of the first ciphertext of the class
+ * canary_class, its name or the number of its column, in the log file
+ * written by ml_kem_encap.py: the names of the classes in the header line
+ * followed by the column numbers of the classes in the order of the
+ * ciphertexts, return 0 on success
+ */
+int find_canary(const char *log_file_name, const char *canary_class,
+                size_t *canary_index) {
+    FILE *log_fp;
+    char *line = NULL, *value, *end;
+    size_t line_size = 0, columns = 0, column = 0, position = 0;
+    int found = 0, result = -1;
+
+    log_fp = fopen(log_file_name, "r");
+    if (!log_fp) {
+        fprintf(stderr, "can't open log file %s\n", log_file_name);
+        return -1;
+    }
+
+    if (getline(&line, &line_size, log_fp) < 0) {
+        fprintf(stderr, "empty log file %s\n", log_file_name);
+        goto out;
+    }
+    line[strcspn(line, "\r\n")] = '\0';
+    for (value = strtok(line, ","); value; value = strtok(NULL, ",")) {
+        if (!found && strcmp(value, canary_class) == 0) {
+            column = columns;
+            found = 1;
+        }
+        columns++;
+    }
+    if (!found) {
+        column = strtoul(canary_class, &end, 10);
+        if (!*canary_class || *end || column >= columns) {
+            fprintf(stderr, "No class %s in log file\n", canary_class);
+            goto out;
+        }
+    }
+
+    while (getline(&line, &line_size, log_fp) >= 0) {
+        for (value = strtok(line, ",\r\n"); value;
+                value = strtok(NULL, ",\r\n")) {
+            if (strtoul(value, NULL, 10) == column) {
+                *canary_index = position;
+                result = 0;
+                goto out;
+            }
+            position++;
+        }
+    }
+    fprintf(stderr, "No ciphertext of class %s in log file\n", canary_class);
+
+    out:
+    free(line);
+    fclose(log_fp);
+    return result;
+}
+
+/* Read exactly len bytes from fd, return 0 on success
+ */
+int read_full(int fd, void *buf, size_t len) {
+    ssize_t r_ret;
+
+    while (len > 0) {
+        r_ret = read(fd, buf, len);
+        if (r_ret <= 0)
+            return -1;
+        buf = (unsigned char *)buf + r_ret;
+        len -= r_ret;
+    }
+    return 0;
+}
+
+/* Write exactly len bytes to fd, return 0 on success
+ */
+int write_full(int fd, const void *buf, size_t len) {
+    ssize_t r_ret;
+
+    while (len > 0) {
+        r_ret = write(fd, buf, len);
+        if (r_ret <= 0)
+            return -1;
+        buf = (const unsigned char *)buf + r_ret;
+        len -= r_ret;
+    }
+    return 0;
+}
+
+/* Write to every page of buf, so that the page faults of the first write
+ * to a freshly allocated (and only mapped to the zero page) buffer happen
+ * now and not in the middle of the measurements
+ */
+void touch_pages(void *buf, size_t len) {
+    volatile unsigned char *p = buf;
+    size_t page_size = sysconf(_SC_PAGESIZE), i;
+
+    for (i = 0; i < len; i += page_size)
+        p[i] = 0;
+    if (len)
+        p[len - 1] = 0;
+}
+
+/* Check the result of decapsulation of a single ciphertext, return 0 if it
+ * succeeded
+ */
+int check_decapsulation(int r_ret, const unsigned char *ciphertext,
+                        size_t plaintext_len) {
+    if (r_ret <= 0) {
+        fprintf(stderr, "Decapsulation failure\n");
+        fprintf(stderr, "%x\n", ciphertext[0]);
+        return -1;
+    }
+
+    if (plaintext_len != 32) {
+        fprintf(stderr, "Unexpected plaintext length: %lu\n", plaintext_len);
+        return -1;
+    }
+    return 0;
+}
+
+/* Decapsulate a single ciphertext and measure how long it took, write the
+ * time to time_diff, return 0 on success
+ */
+int measure_decapsulation(EVP_PKEY_CTX *ctx, unsigned char *plaintext,
+                          const unsigned char *ciphertext,
+                          size_t ciphertext_len, uint64_t *time_diff) {
+    int r_ret;
+    size_t plaintext_len = ciphertext_len;
+    uint64_t time_before, time_after;
+
+    time_before = get_time_before();
+
+    r_ret = EVP_PKEY_decapsulate(ctx, plaintext, &plaintext_len,
+                                 ciphertext, ciphertext_len);
+
+    time_after = get_time_after();
+
+    if (check_decapsulation(r_ret, ciphertext, plaintext_len) != 0)
+        return -1;
+
+    *time_diff = time_after - time_before;
+    return 0;
+}
+
+/* Decapsulate a single ciphertext again, without timing it, and write the
+ * change of the counters_count hardware counters of the counters_fd group
+ * to values, return 0 on success. Reading the counters takes system calls,
+ * so it's kept out of the timed decapsulations.
+ */
+int count_decapsulation(EVP_PKEY_CTX *ctx, unsigned char *plaintext,
+                        const unsigned char *ciphertext,
+                        size_t ciphertext_len, int counters_fd,
+                        size_t counters_count, uint64_t *values) {
+    int r_ret;
+    size_t plaintext_len = ciphertext_len, i;
+    ssize_t counters_len = (counters_count + 1) * sizeof(uint64_t);
+    /* number of counters followed by their values */
+    uint64_t counters_before[MAX_COUNTERS + 1];
+    uint64_t counters_after[MAX_COUNTERS + 1];
+
+    if (read(counters_fd, counters_before, counters_len) != counters_len) {
+        fprintf(stderr, "Can't read counters\n");
+        return -1;
+    }
+
+    r_ret = EVP_PKEY_decapsulate(ctx, plaintext, &plaintext_len,
+                                 ciphertext, ciphertext_len);
+
+    if (read(counters_fd, counters_after, counters_len) != counters_len) {
+        fprintf(stderr, "Can't read counters\n");
+        return -1;
+    }
+
+    if (check_decapsulation(r_ret, ciphertext, plaintext_len) != 0)
+        return -1;
+
+    for (i = 0; i < counters_count; i++)
+        values[i] = counters_after[i + 1] - counters_before[i + 1];
+    return 0;
+}
+
 int main(int argc, char *argv[]) {
     int result = 1, r_ret;
-    EVP_PKEY_CTX *ctx = NULL;
-    EVP_PKEY *pkey = NULL;
-    size_t plaintext_len = 0;
+    EVP_PKEY_CTX *ctx = NULL, **ctxs = NULL;
+    EVP_PKEY *pkey = NULL, **pkeys = NULL;
+    void *new_keys;
+    size_t keys_count = 0, i;
+    uint16_t key_index;
+    uint16_t *key_indexes = NULL;
     size_t ciphertext_len = 0;
-    FILE *fp;
+    size_t count = 0, n;
+    size_t warm_up = 0, canary_period = 0, canary_count = 0;
+    size_t canary_index = 0;
+    struct stat in_stat;
+    int batch = 0;
+    int perf_fds[2] = {-1, -1};
+    int counter_fds[MAX_COUNTERS] = {-1, -1, -1, -1};
+    size_t counters_count = 0, record_len = 1;
+    char *counter_names = NULL;
+    FILE *fp = NULL;
     char *key_file_name = NULL, *in_file_name = NULL, *out_file_name = NULL;
-    int in_fd = -1, out_fd = -1;
-    unsigned char *ciphertext = NULL;
+    char *key_index_file_name = NULL, *metadata_file_name = NULL;
+    char *sample_info_file_name = NULL, *canary_file_name = NULL;
+    char *log_file_name = NULL, *canary_class = NULL;
+    int canary_index_set = 0;
+    int in_fd = -1, out_fd = -1, key_index_fd = -1;
+    int sample_info_fd = -1, canary_fd = -1;
+    unsigned char *ciphertext = NULL, *ciphertexts = NULL;
     unsigned char *plaintext = NULL;
     int opt;
-    uint64_t time_before, time_after, time_diff;
+    uint64_t time_diff, record[MAX_COUNTERS + 1], *times = NULL;
+    uint64_t sequence = 0, disturbances = 0, reading;
+    uint64_t *samples = NULL, *canaries = NULL, *canary;
 
-    while ((opt = getopt(argc, argv, "i:o:k:n:h")) != -1 ) {
+    while ((opt = getopt(argc, argv,
+                         "i:o:k:n:x:bm:w:s:c:C:a:l:A:e:h")) != -1 ) {
         switch (opt) {
             case 'i':
                 in_file_name = optarg;
@@ -147,6 +613,40 @@ int main(int argc, char *argv[]) {
             case 'n':
                 sscanf(optarg, "%zi", &ciphertext_len);
                 break;
+            case 'x':
+                key_index_file_name = optarg;
+                break;
+            case 'b':
+                batch = 1;
+                break;
+            case 'm':
+                metadata_file_name = optarg;
+                break;
+            case 'w':
+                sscanf(optarg, "%zi", &warm_up);
+                break;
+            case 's':
+                sample_info_file_name = optarg;
+                break;
+            case 'c':
+                sscanf(optarg, "%zi", &canary_period);
+                break;
+            case 'C':
+                canary_file_name = optarg;
+                break;
+            case 'a':
+                sscanf(optarg, "%zi", &canary_index);
+                canary_index_set = 1;
+                break;
+            case 'l':
+                log_file_name = optarg;
+                break;
+            case 'A':
+                canary_class = optarg;
+                break;
+            case 'e':
+                counter_names = optarg;
+                break;
             case 'h':
                 help(argv[0]);
                 exit(0);
@@ -165,6 +665,43 @@ int main(int argc, char *argv[]) {
         exit(1);
     }
 
+    if (!batch && (warm_up || sample_info_file_name || canary_period ||
+                   canary_file_name)) {
+        fprintf(stderr, "-w, -s, -c and -C require batch mode (-b)\n");
+        exit(1);
+    }
+
+    if (!canary_period != !canary_file_name) {
+        fprintf(stderr, "-c and -C must be used together\n");
+        exit(1);
+    }
+
+    if (!log_file_name != !canary_class) {
+        fprintf(stderr, "-l and -A must be used together\n");
+        exit(1);
+    }
+
+    if (canary_index_set && canary_class) {
+        fprintf(stderr, "-a and -A are mutually exclusive\n");
+        exit(1);
+    }
+
+    if ((canary_index_set || canary_class) && !canary_period) {
+        fprintf(stderr, "-a and -A require canaries (-c)\n");
+        exit(1);
+    }
+
+    if (canary_class &&
+            find_canary(log_file_name, canary_class, &canary_index) != 0)
+        exit(1);
+
+    if (counter_names) {
+        if (open_hardware_counters(counter_names, counter_fds,
+                                   &counters_count) != 0)
+            goto err;
+        record_len += counters_count;
+    }
+
     in_fd = open(in_file_name, O_RDONLY);
     if (in_fd == -1) {
         fprintf(stderr, "can't open input file %s\n", in_file_name);
@@ -177,6 +714,33 @@ int main(int argc, char *argv[]) {
         goto err;
     }
 
+    if (sample_info_file_name) {
+        sample_info_fd = open(sample_info_file_name,
+                              O_WRONLY|O_TRUNC|O_CREAT, 0666);
+        if (sample_info_fd == -1) {
+            fprintf(stderr, "can't open sample info file %s\n",
+                    sample_info_file_name);
+            goto err;
+        }
+    }
+
+    if (canary_file_name) {
+        canary_fd = open(canary_file_name, O_WRONLY|O_TRUNC|O_CREAT, 0666);
+        if (canary_fd == -1) {
+            fprintf(stderr, "can't open canary file %s\n", canary_file_name);
+            goto err;
+        }
+    }
+
+    if (key_index_file_name) {
+        key_index_fd = open(key_index_file_name, O_RDONLY);
+        if (key_index_fd == -1) {
+            fprintf(stderr, "can't open key index file %s\n",
+                    key_index_file_name);
+            goto err;
+        }
+    }
+
     fprintf(stderr, "malloc(plaintext)\n");
     plaintext = malloc(ciphertext_len);
     if (!plaintext)
@@ -195,54 +759,270 @@ int main(int argc, char *argv[]) {
     }
 
     fprintf(stderr, "PEM_read_PrivateKey()\n");
-    if ((pkey = PEM_read_PrivateKey(fp, NULL, NULL, NULL)) == NULL)
+    while ((pkey = PEM_read_PrivateKey(fp, NULL, NULL, NULL)) != NULL) {
+        new_keys = realloc(pkeys, (keys_count + 1) * sizeof(*pkeys));
+        if (!new_keys) {
+            EVP_PKEY_free(pkey);
+            goto err;
+        }
+        pkeys = new_keys;
+        pkeys[keys_count++] = pkey;
+    }
+    if (keys_count == 0)
+        goto err;
+    /* reading of the keys stops with an error at the end of the file */
+    ERR_clear_error();
+
+    if (keys_count > 1 && key_index_fd == -1) {
+        fprintf(stderr, "Multiple keys require a key index file (-x)\n");
         goto err;
+    }
 
     fprintf(stderr, "fclose()\n");
     if (fclose(fp) != 0)
         goto err;
     fp = NULL;
 
-    fprintf(stderr, "EVP_PKEY_CTX_new_from_pkey()\n");
-    ctx = EVP_PKEY_CTX_new_from_pkey(NULL, pkey, NULL);
-    if (!ctx)
+    ctxs = calloc(keys_count, sizeof(*ctxs));
+    if (!ctxs)
         goto err;
 
-    fprintf(stderr, "EVP_PKEY_decapsulate_init()\n");
-    if (EVP_PKEY_decapsulate_init(ctx, NULL) <= 0)
-        goto err;
+    for (i = 0; i < keys_count; i++) {
+        fprintf(stderr, "EVP_PKEY_CTX_new_from_pkey()\n");
+        ctxs[i] = EVP_PKEY_CTX_new_from_pkey(NULL, pkeys[i], NULL);
+        if (!ctxs[i])
+            goto err;
 
-    fprintf(stderr, "Decrypting ciphertexts...\n");
+        fprintf(stderr, "EVP_PKEY_decapsulate_init()\n");
+        if (EVP_PKEY_decapsulate_init(ctxs[i], NULL) <= 0)
+            goto err;
+    }
+    ctx = ctxs[0];
 
-    while ((r_ret = read(in_fd, ciphertext, ciphertext_len)) > 0) {
-        if (r_ret != ciphertext_len) {
-            fprintf(stderr, "read less data than expected (truncated file?)\n");
+    if (metadata_file_name) {
+        fprintf(stderr, "Calibrating the clock...\n");
+        if (write_timer_metadata(metadata_file_name) != 0)
+            goto err;
+    }
+
+    if (batch) {
+        if (fstat(in_fd, &in_stat) != 0)
+            goto err;
+        if (in_stat.st_size % ciphertext_len) {
+            fprintf(stderr, "truncated input file\n");
             goto err;
         }
+        count = in_stat.st_size / ciphertext_len;
 
-        plaintext_len = ciphertext_len;
+        fprintf(stderr, "malloc(ciphertexts)\n");
+        ciphertexts = malloc(count * ciphertext_len + 1);
+        if (!ciphertexts)
+            goto err;
+        if (read_full(in_fd, ciphertexts, count * ciphertext_len) != 0) {
+            fprintf(stderr, "can't read input file\n");
+            goto err;
+        }
 
-        time_before = get_time_before();
+        if (key_index_fd >= 0) {
+            fprintf(stderr, "malloc(key_indexes)\n");
+            key_indexes = malloc(count * sizeof(*key_indexes) + 1);
+            if (!key_indexes)
+                goto err;
+            if (read_full(key_index_fd, key_indexes,
+                          count * sizeof(*key_indexes)) != 0) {
+                fprintf(stderr, "key index file too short\n");
+                goto err;
+            }
+            for (n = 0; n < count; n++) {
+                key_indexes[n] = le16toh(key_indexes[n]);
+                if (key_indexes[n] >= keys_count) {
+                    fprintf(stderr, "No key with index %u\n", key_indexes[n]);
+                    goto err;
+                }
+            }
+        }
 
-        r_ret = EVP_PKEY_decapsulate(ctx, plaintext, &plaintext_len,
-                                     ciphertext, ciphertext_len);
+        fprintf(stderr, "calloc(times)\n");
+        times = calloc((count + 1) * record_len, sizeof(*times));
+        if (!times)
+            goto err;
+        /* calloc() of a large buffer only maps it, fault its pages in
+         * before the measurements write to them
+         */
+        touch_pages(times, (count + 1) * record_len * sizeof(*times));
 
-        time_after = get_time_after();
+        if (sample_info_fd >= 0) {
+            fprintf(stderr, "calloc(samples)\n");
+            samples = calloc(2 * count + 1, sizeof(*samples));
+            if (!samples)
+                goto err;
+            touch_pages(samples, (2 * count + 1) * sizeof(*samples));
+        }
 
-        if (r_ret <= 0) {
-            fprintf(stderr, "Decapsulation failure\n");
-            fprintf(stderr, "%x\n", ciphertext[0]);
+        if (canary_fd >= 0) {
+            if (count && canary_index >= count) {
+                fprintf(stderr, "No ciphertext with the canary index\n");
+                goto err;
+            }
+            canary_count = (count + canary_period - 1) / canary_period;
+            fprintf(stderr, "calloc(canaries)\n");
+            canaries = calloc(3 * canary_count + 1, sizeof(*canaries));
+            if (!canaries)
+                goto err;
+            touch_pages(canaries, (3 * canary_count + 1) * sizeof(*canaries));
+        }
+
+        if ((samples || canaries) &&
+                open_disturbance_counters(perf_fds) != 0)
+            fprintf(stderr, "perf_event_open() failed, counting only "
+                    "context switches\n");
+
+        if (warm_up && count) {
+            fprintf(stderr, "Warming up...\n");
+            for (n = 0; n < warm_up; n++) {
+                if (key_indexes)
+                    ctx = ctxs[key_indexes[n % count]];
+
+                if (measure_decapsulation(
+                        ctx, plaintext,
+                        ciphertexts + n % count * ciphertext_len,
+                        ciphertext_len, &time_diff) != 0)
+                    goto err;
+            }
+        }
+
+        fprintf(stderr, "Decrypting ciphertexts...\n");
+
+        /* the counters are read only after the measurements, the
+         * disturbances of a measurement are the difference from the
+         * previous reading
+         */
+        if (samples || canaries)
+            disturbances = read_disturbances(perf_fds[0]);
+
+        for (n = 0; n < count; n++) {
+            /* the canary ciphertext, measured again */
+            if (canaries && n % canary_period == 0) {
+                canary = canaries + 3 * (n / canary_period);
+                if (key_indexes)
+                    ctx = ctxs[key_indexes[canary_index]];
+
+                if (measure_decapsulation(
+                        ctx, plaintext,
+                        ciphertexts + canary_index * ciphertext_len,
+                        ciphertext_len, &canary[1]) != 0)
+                    goto err;
+                reading = read_disturbances(perf_fds[0]);
+                canary[2] = reading - disturbances;
+                disturbances = reading;
+                canary[0] = sequence++;
+            }
+
+            if (key_indexes)
+                ctx = ctxs[key_indexes[n]];
+
+            if (measure_decapsulation(ctx, plaintext,
+                                      ciphertexts + n * ciphertext_len,
+                                      ciphertext_len,
+                                      times + n * record_len) != 0)
+                goto err;
+
+            if (samples) {
+                reading = read_disturbances(perf_fds[0]);
+                samples[2 * n + 1] = reading - disturbances;
+                samples[2 * n] = sequence;
+                disturbances = reading;
+            } else if (canaries && (n + 1) % canary_period == 0) {
+                /* without the sample info only the next canary needs it */
+                disturbances = read_disturbances(perf_fds[0]);
+            }
+            sequence++;
+        }
+
+        if (counters_count) {
+            fprintf(stderr, "Counting events...\n");
+            ctx = ctxs[0];
+            for (n = 0; n < count; n++) {
+                if (key_indexes)
+                    ctx = ctxs[key_indexes[n]];
+
+                if (count_decapsulation(ctx, plaintext,
+                                        ciphertexts + n * ciphertext_len,
+                                        ciphertext_len, counter_fds[0],
+                                        counters_count,
+                                        times + n * record_len + 1) != 0)
+                    goto err;
+            }
+        }
+
+        for (n = 0; n < count * record_len; n++)
+            times[n] = htole64(times[n]);
+        if (write_full(out_fd, times,
+                       count * record_len * sizeof(*times)) != 0) {
+            fprintf(stderr, "Write error\n");
             goto err;
         }
 
-        if (plaintext_len != 32) {
-            fprintf(stderr, "Unexpected plaintext length: %lu\n", plaintext_len);
+        if (samples) {
+            for (n = 0; n < 2 * count; n++)
+                samples[n] = htole64(samples[n]);
+            if (write_full(sample_info_fd, samples,
+                           2 * count * sizeof(*samples)) != 0) {
+                fprintf(stderr, "Write error\n");
+                goto err;
+            }
+        }
+
+        if (canaries) {
+            for (n = 0; n < 3 * canary_count; n++)
+                canaries[n] = htole64(canaries[n]);
+            if (write_full(canary_fd, canaries,
+                           3 * canary_count * sizeof(*canaries)) != 0) {
+                fprintf(stderr, "Write error\n");
+                goto err;
+            }
+        }
+
+        result = 0;
+        fprintf(stderr, "finished\n");
+        goto out;
+    }
+
+    fprintf(stderr, "Decrypting ciphertexts...\n");
+
+    while ((r_ret = read(in_fd, ciphertext, ciphertext_len)) > 0) {
+        if (r_ret != (ssize_t)ciphertext_len) {
+            fprintf(stderr, "read less data than expected (truncated file?)\n");
             goto err;
         }
 
-        time_diff = time_after - time_before;
+        if (key_index_fd >= 0) {
+            if (read(key_index_fd, &key_index, sizeof(key_index))
+                    != sizeof(key_index)) {
+                fprintf(stderr, "key index file too short\n");
+                goto err;
+            }
+            key_index = le16toh(key_index);
+            if (key_index >= keys_count) {
+                fprintf(stderr, "No key with index %u\n", key_index);
+                goto err;
+            }
+            ctx = ctxs[key_index];
+        }
 
-        r_ret = write(out_fd, &time_diff, sizeof(time_diff));
+        if (measure_decapsulation(ctx, plaintext, ciphertext, ciphertext_len,
+                                  record) != 0)
+            goto err;
+
+        if (counters_count &&
+                count_decapsulation(ctx, plaintext, ciphertext,
+                                    ciphertext_len, counter_fds[0],
+                                    counters_count, record + 1) != 0)
+            goto err;
+
+        for (i = 0; i < record_len; i++)
+            record[i] = htole64(record[i]);
+        r_ret = write(out_fd, record, record_len * sizeof(*record));
         if (r_ret <= 0) {
             fprintf(stderr, "Write error\n");
             goto err;
@@ -261,16 +1041,46 @@ int main(int argc, char *argv[]) {
     out:
     if (ciphertext)
         free(ciphertext);
+    if (ciphertexts)
+        free(ciphertexts);
+    if (key_indexes)
+        free(key_indexes);
+    if (times)
+        free(times);
+    if (samples)
+        free(samples);
+    if (canaries)
+        free(canaries);
     if (plaintext)
         free(plaintext);
-    if (ctx)
-        EVP_PKEY_CTX_free(ctx);
-    if (pkey)
-        EVP_PKEY_free(pkey);
+    if (fp)
+        fclose(fp);
+    if (ctxs) {
+        for (i = 0; i < keys_count; i++)
+            EVP_PKEY_CTX_free(ctxs[i]);
+        free(ctxs);
+    }
+    if (pkeys) {
+        for (i = 0; i < keys_count; i++)
+            EVP_PKEY_free(pkeys[i]);
+        free(pkeys);
+    }
     if (in_fd >= 0)
         close(in_fd);
     if (out_fd >= 0)
         close(out_fd);
+    if (key_index_fd >= 0)
+        close(key_index_fd);
+    if (sample_info_fd >= 0)
+        close(sample_info_fd);
+    if (canary_fd >= 0)
+        close(canary_fd);
+    for (i = counters_count; i > 0; i--)
+        close(counter_fds[i - 1]);
+    if (perf_fds[1] >= 0)
+        close(perf_fds[1]);
+    if (perf_fds[0] >= 0)
+        close(perf_fds[0]);
     return result;
 }
 
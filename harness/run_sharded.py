@@ -0,0 +1,280 @@
+import os
+import sys
+import csv
+import getopt
+import subprocess
+from array import array
+
+
+def help_msg():
+    print("""
+run_sharded.py -i file -l file -o file -n size -c cpus [-x file] [-b]
+               [--keep-shards] -- harness [harness options]
+
+Run multiple instances of a decapsulation harness in parallel, each one
+pinned to a different CPU and measuring a different part of the
+ciphertexts file, then merge their times.
+
+The ciphertexts file is split into consecutive shards of whole rows of
+log.csv, so every shard has the same number of ciphertexts of every class.
+Every instance is started as:
+    harness [harness options] -i ciphers-shard-N.bin -o raw_times-shard-N
+        [-x key_index-shard-N.bin]
+
+The merged file has the times of all the ciphertexts, in the order of the
+ciphertexts file, in the "raw times" column and the number of the shard
+(instance) that measured them in the "shard" column; use it with
+extract.py -n "raw times". The times and log.csv of every shard
+(raw_times-shard-N.csv or .bin and log-shard-N.csv) are kept in the
+directory of the output file, for analysis of every CPU separately.
+
+-i file        File with the ciphertexts (ciphers.bin)
+-l file        File with the order of the ciphertexts (log.csv)
+-o file        File to write the merged times to
+-n size        Size of individual ciphertexts
+-c cpus        Comma separated list of CPUs to run the instances on, with
+               ranges: "2-9" or "2,4,6,8". One instance per CPU.
+-x file        Key index file (key_index.bin), split into shards for the
+               harness -x option
+-b             The harness writes the times in binary format, as 8 byte
+               little-endian integers (harness/kyber-py/mlkem_decap.py -b,
+               harness/openssl/time_decapsulate)
+--keep-shards  Don't remove the ciphertexts and key index shards
+-h | --help    this message
+
+Example:
+run_sharded.py -i test-dir/ciphers.bin -l test-dir/log.csv \\
+    -o test-dir/raw_times.csv -n 1088 -c 2-9 -b -- \\
+    ./harness/openssl/time_decapsulate -k ml-kem-768-dk.pem -n 1088
+""")
+
+
+def parse_cpus(cpus):
+    """Return the list of CPUs from a "0,2-4" style list."""
+    ret = []
+    for item in cpus.split(","):
+        if "-" in item:
+            first, last = item.split("-")
+            ret.extend(range(int(first), int(last) + 1))
+        else:
+            ret.append(int(item))
+    return ret
+
+
+def read_log(log_file):
+    """Return the header and the rows of the log file."""
+    with open(log_file, "r") as log_fd:
+        reader = csv.reader(log_fd)
+        header = next(reader)
+        rows = [row for row in reader if row]
+    return header, rows
+
+
+def copy_range(in_fd, out_file, start, length):
+    """Copy length bytes starting at start from in_fd to out_file."""
+    in_fd.seek(start)
+    with open(out_file, "wb") as out_fd:
+        while length:
+            data = in_fd.read(min(length, 1 << 20))
+            if not data:
+                raise ValueError("Truncated file {0}".format(in_fd.name))
+            out_fd.write(data)
+            length -= len(data)
+
+
+def read_times(times_file, binary):
+    """Return the list of times from a harness output file."""
+    if binary:
+        times = array("Q")
+        with open(times_file, "rb") as times_fd:
+            times.frombytes(times_fd.read())
+        if sys.byteorder == "big":
+            times.byteswap()
+        return times
+
+    with open(times_file, "r") as times_fd:
+        # skip the "raw times" header
+        next(times_fd)
+        return [line.strip() for line in times_fd if line.strip()]
+
+
+def make_shards(in_file, log_file, key_index_file, read_size, count,
+                out_dir):
+    """
+    Split the ciphertexts, log and key index files into count shards.
+
+    Returns a list with the number of ciphertexts in every shard.
+    """
+    header, rows = read_log(log_file)
+    classes = len(header)
+
+    if os.path.getsize(in_file) != len(rows) * classes * read_size:
+        raise ValueError("Size of {0} doesn't match {1}".format(
+            in_file, log_file))
+
+    rows_per_shard = -(-len(rows) // count)
+    sizes = []
+    with open(in_file, "rb") as in_fd:
+        key_index_fd = open(key_index_file, "rb") if key_index_file \
+            else None
+        try:
+            for shard in range(count):
+                shard_rows = rows[shard * rows_per_shard:
+                                  (shard + 1) * rows_per_shard]
+                start = shard * rows_per_shard * classes
+                size = len(shard_rows) * classes
+                sizes.append(size)
+
+                copy_range(in_fd, os.path.join(
+                    out_dir, "ciphers-shard-{0}.bin".format(shard)),
+                    start * read_size, size * read_size)
+                if key_index_fd:
+                    copy_range(key_index_fd, os.path.join(
+                        out_dir, "key_index-shard-{0}.bin".format(shard)),
+                        start * 2, size * 2)
+
+                with open(os.path.join(
+                        out_dir, "log-shard-{0}.csv".format(shard)),
+                        "w") as log_fd:
+                    writer = csv.writer(log_fd)
+                    writer.writerow(header)
+                    writer.writerows(shard_rows)
+        finally:
+            if key_index_fd:
+                key_index_fd.close()
+    return sizes
+
+
+def run_shards(harness, cpus, key_index_file, binary, out_dir):
+    """Run one harness instance per CPU, return True if all succeeded."""
+    processes = []
+    for shard, cpu in enumerate(cpus):
+        times_file = os.path.join(out_dir, "raw_times-shard-{0}.{1}".format(
+            shard, "bin" if binary else "csv"))
+        cmd = harness + [
+            "-i", os.path.join(out_dir, "ciphers-shard-{0}.bin".format(shard)),
+            "-o", times_file]
+        if key_index_file:
+            cmd += ["-x", os.path.join(
+                out_dir, "key_index-shard-{0}.bin".format(shard))]
+
+        print("Starting shard {0} on CPU {1}".format(shard, cpu))
+        processes.append(subprocess.Popen(
+            cmd, preexec_fn=lambda cpu=cpu: os.sched_setaffinity(0, [cpu])))
+
+    success = True
+    for shard, process in enumerate(processes):
+        if process.wait() != 0:
+            print("ERROR: shard {0} failed".format(shard), file=sys.stderr)
+            success = False
+    return success
+
+
+def merge_times(out_file, sizes, binary, out_dir):
+    """Write the times of all the shards to out_file with shard numbers."""
+    with open(out_file, "w") as out_fd:
+        out_fd.write("raw times,shard\n")
+        for shard, size in enumerate(sizes):
+            times = read_times(os.path.join(
+                out_dir, "raw_times-shard-{0}.{1}".format(
+                    shard, "bin" if binary else "csv")), binary)
+            if len(times) != size:
+                raise ValueError(
+                    "Shard {0} has {1} times, expected {2}".format(
+                        shard, len(times), size))
+            out_fd.write("".join(
+                "{0},{1}\n".format(i, shard) for i in times))
+
+
+if __name__ == '__main__':
+    in_file = None
+    log_file = None
+    out_file = None
+    read_size = None
+    cpus = None
+    key_index_file = None
+    binary = False
+    keep_shards = False
+
+    argv = sys.argv[1:]
+    if not argv:
+        help_msg()
+        sys.exit(1)
+    opts, harness = getopt.getopt(argv, "i:l:o:n:c:x:bh",
+                                  ["help", "keep-shards"])
+
+    for opt, arg in opts:
+        if opt == "-h" or opt == "--help":
+            help_msg()
+            sys.exit(0)
+        elif opt == "-i":
+            in_file = arg
+        elif opt == "-l":
+            log_file = arg
+        elif opt == "-o":
+            out_file = arg
+        elif opt == "-n":
+            read_size = int(arg)
+        elif opt == "-c":
+            cpus = parse_cpus(arg)
+        elif opt == "-x":
+            key_index_file = arg
+        elif opt == "-b":
+            binary = True
+        elif opt == "--keep-shards":
+            keep_shards = True
+        else:
+            raise ValueError("Unrecognised parameter: {0} {1}"
+                             .format(opt, arg))
+
+    if not in_file:
+        print("ERROR: no input file specified (-i)", file=sys.stderr)
+        sys.exit(1)
+
+    if not log_file:
+        print("ERROR: no log file specified (-l)", file=sys.stderr)
+        sys.exit(1)
+
+    if not out_file:
+        print("ERROR: no output file specified (-o)", file=sys.stderr)
+        sys.exit(1)
+
+    if not read_size:
+        print("ERROR: size of ciphertexts unspecified (-n)", file=sys.stderr)
+        sys.exit(1)
+
+    if not cpus:
+        print("ERROR: no CPUs specified (-c)", file=sys.stderr)
+        sys.exit(1)
+
+    if not set(cpus) <= os.sched_getaffinity(0):
+        print("ERROR: CPUs {0} are not available".format(
+            ",".join(str(i) for i in sorted(set(cpus) -
+                                             os.sched_getaffinity(0)))),
+              file=sys.stderr)
+        sys.exit(1)
+
+    if not harness:
+        print("ERROR: no harness command specified", file=sys.stderr)
+        sys.exit(1)
+
+    out_dir = os.path.dirname(out_file) or "."
+
+    sizes = make_shards(in_file, log_file, key_index_file, read_size,
+                        len(cpus), out_dir)
+    success = run_shards(harness, cpus, key_index_file, binary, out_dir)
+
+    if not keep_shards:
+        for shard in range(len(cpus)):
+            os.remove(os.path.join(
+                out_dir, "ciphers-shard-{0}.bin".format(shard)))
+            if key_index_file:
+                os.remove(os.path.join(
+                    out_dir, "key_index-shard-{0}.bin".format(shard)))
+
+    if not success:
+        sys.exit(1)
+
+    merge_times(out_file, sizes, binary, out_dir)
+
+    print("done")
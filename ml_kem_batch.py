@@ -0,0 +1,585 @@
+"""Vectorised ML-KEM decapsulation that tracks intermediate values."""
+
+from os.path import getsize
+import numpy as np
+
+Q = 3329
+N = 256
+
+# zetas in bit-reversed order, as used by the NTT of FIPS 203
+ZETAS = np.array([pow(17, int("{0:07b}".format(i)[::-1], 2), Q)
+                  for i in range(128)], dtype=np.int64)
+
+# 128^-1 mod q, scaling factor of the inverse NTT
+NTT_F = pow(128, -1, Q)
+
+# multipliers for the base case multiplication of pairs of coefficients
+GAMMAS = np.stack([ZETAS[64:], -ZETAS[64:]], axis=1).reshape(128)
+
+# record of the side data file written by ml_kem_encap.py, one for every
+# ciphertext in ciphers.bin
+SIDE_DATA_DTYPE = np.dtype([("probe", "<u2"), ("flags", "u1"),
+                            ("m", "u1", (32,)), ("K", "u1", (32,))])
+
+# the m and K fields of the record are set, decapsulation of the ciphertext
+# must return K
+SIDE_DATA_KNOWN = 1
+
+# entry of the key index file written by ml_kem_encap.py when encapsulating
+# to multiple keys: position of the key of every ciphertext in ciphers.bin
+# in the list of keys
+KEY_INDEX_DTYPE = np.dtype("<u2")
+
+_POPCOUNT_8 = np.array([bin(i).count("1") for i in range(256)],
+                       dtype=np.int64)
+
+
+def hamming_weight(values):
+    """Return the number of set bits in every element of the array."""
+    values = np.asarray(values)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values).astype(np.int64)
+    if values.dtype == np.uint8:
+        return _POPCOUNT_8[values]
+    values = values.astype(np.uint64)
+    ret = np.zeros(values.shape, dtype=np.int64)
+    for _ in range(8):
+        ret += _POPCOUNT_8[values & 0xff]
+        values = values >> np.uint64(8)
+    return ret
+
+
+def bit_size(values):
+    """Return the bit length of every element of a non-negative array."""
+    return np.frexp(np.asarray(values, dtype=np.float64))[1].astype(np.int64)
+
+
+def byte_decode(data, d):
+    """
+    Decode arrays of bytes into polynomials with d-bit coefficients.
+
+    data must have the last dimension a multiple of 32 * d, every 32 * d
+    bytes are decoded into 256 coefficients.
+    """
+    data = np.asarray(data, dtype=np.uint8)
+    bits = np.unpackbits(data, axis=-1, bitorder="little")
+    bits = bits.reshape(data.shape[:-1] + (-1, N, d)).astype(np.int64)
+    coeffs = bits @ (1 << np.arange(d, dtype=np.int64))
+    if d == 12:
+        coeffs %= Q
+    return coeffs
+
+
+def byte_encode(coeffs, d):
+    """
+    Encode polynomials with d-bit coefficients into bytes.
+
+    All the polynomials in the last but one dimension are concatenated.
+    """
+    coeffs = np.asarray(coeffs, dtype=np.int64)
+    bits = (coeffs[..., None] >> np.arange(d, dtype=np.int64)) & 1
+    bits = bits.astype(np.uint8).reshape(coeffs.shape[:-2] + (-1,))
+    return np.packbits(bits, axis=-1, bitorder="little")
+
+
+def compress(coeffs, d):
+    """Compute round((2^d / q) * x) % 2^d for every coefficient."""
+    return (((coeffs << d) + Q // 2) // Q) & ((1 << d) - 1)
+
+
+def decompress(coeffs, d):
+    """Compute round((q / 2^d) * x) for every coefficient."""
+    return (Q * coeffs + (1 << (d - 1))) >> d
+
+
+def _count_butterflies(counts, sums, differences, multiplied):
+    """
+    Add statistics of a layer of butterflies to the counts dictionary.
+
+    "reductions" counts sums >= q and negative differences, i.e. the
+    butterfly results that need a conditional correction, "zeros" counts
+    the zero values multiplied by a zeta.
+    """
+    axes = (-2, -1)
+    reductions = (sums >= Q).sum(axis=axes) + (differences < 0).sum(axis=axes)
+    zeros = (multiplied == 0).sum(axis=axes)
+    counts["reductions"] = counts.get("reductions", 0) + reductions
+    counts["zeros"] = counts.get("zeros", 0) + zeros
+
+
+def ntt(coeffs, counts=None):
+    """
+    Convert polynomials to the NTT domain.
+
+    The input is in standard order, the output is in bit-reversed order.
+
+    If counts is a dictionary, numbers of reductions and of multiplications
+    of zeros in the butterflies of every polynomial are added to it, see
+    _count_butterflies().
+    """
+    shape = coeffs.shape
+    coeffs = coeffs % Q
+    k = 1
+    length = 128
+    while length >= 2:
+        blocks = N // (2 * length)
+        coeffs = coeffs.reshape(shape[:-1] + (blocks, 2, length))
+        zetas = ZETAS[k:k + blocks, None]
+        k += blocks
+        t = (zetas * coeffs[..., 1, :]) % Q
+        sums = coeffs[..., 0, :] + t
+        differences = coeffs[..., 0, :] - t
+        if counts is not None:
+            _count_butterflies(counts, sums, differences, coeffs[..., 1, :])
+        coeffs = np.stack([sums % Q, differences % Q], axis=-2)
+        length >>= 1
+    return coeffs.reshape(shape)
+
+
+def intt(coeffs, counts=None):
+    """
+    Convert polynomials from the NTT domain.
+
+    The input is in bit-reversed order, the output is in standard order.
+
+    If counts is a dictionary, numbers of reductions and of multiplications
+    of zeros in the butterflies of every polynomial are added to it, see
+    _count_butterflies().
+    """
+    shape = coeffs.shape
+    k = 127
+    length = 2
+    while length <= 128:
+        blocks = N // (2 * length)
+        coeffs = coeffs.reshape(shape[:-1] + (blocks, 2, length))
+        zetas = ZETAS[k:k - blocks:-1, None]
+        k -= blocks
+        even, odd = coeffs[..., 0, :], coeffs[..., 1, :]
+        sums = even + odd
+        differences = odd - even
+        if counts is not None:
+            _count_butterflies(counts, sums, differences, differences % Q)
+        coeffs = np.stack([sums % Q, (zetas * differences) % Q], axis=-2)
+        length <<= 1
+    return (coeffs.reshape(shape) * NTT_F) % Q
+
+
+def ntt_multiply(f_hat, g_hat):
+    """Multiply polynomials in the NTT domain."""
+    f_hat = f_hat.reshape(f_hat.shape[:-1] + (128, 2))
+    g_hat = g_hat.reshape(g_hat.shape[:-1] + (128, 2))
+    a0, a1 = f_hat[..., 0], f_hat[..., 1]
+    b0, b1 = g_hat[..., 0], g_hat[..., 1]
+    r0 = (a0 * b0 + (a1 * b1 % Q) * GAMMAS) % Q
+    r1 = (a1 * b0 + a0 * b1) % Q
+    return np.stack([r0, r1], axis=-1).reshape(r0.shape[:-1] + (N,))
+
+
+def ntt_dot(f_hat, g_hat):
+    """
+    Dot product of vectors of polynomials in NTT domain.
+
+    The vectors are stored in the last but one dimension.
+    """
+    return ntt_multiply(f_hat, g_hat).sum(axis=-2) % Q
+
+
+def cbd(data, eta):
+    """Sample polynomials from the centered binomial distribution."""
+    bits = np.unpackbits(data, axis=-1, bitorder="little")
+    bits = bits.reshape(data.shape[:-1] + (N, 2, eta)).astype(np.int64)
+    sums = bits.sum(axis=-1)
+    return (sums[..., 0] - sums[..., 1]) % Q
+
+
+def _prf_cbd(kem, seeds, eta, nonce):
+    """Sample a polynomial for every seed using PRF with nonce."""
+    data = np.frombuffer(
+        b"".join(kem._prf(eta, seed, bytes([nonce])) for seed in seeds),
+        dtype=np.uint8).reshape(len(seeds), 64 * eta)
+    return cbd(data, eta)
+
+
+def _first_and_last_difference(c, c_prime):
+    """Return positions of the first and last different bytes, or -1."""
+    diff = c != c_prime
+    any_diff = diff.any(axis=1)
+    first = np.where(any_diff, diff.argmax(axis=1), -1)
+    last = np.where(any_diff, c.shape[1] - 1 - diff[:, ::-1].argmax(axis=1),
+                    -1)
+    return first, last
+
+
+class CiphertextFile(object):
+    """
+    Memory mapped file with concatenated ciphertexts of the same size.
+
+    The ciphertexts are available as an (N, ciphertext_size) array of uint8
+    in the array attribute, or as memoryview objects by indexing the
+    instance. Neither copies the data.
+    """
+
+    def __init__(self, filename, ciphertext_size):
+        self.filename = filename
+        self.ciphertext_size = ciphertext_size
+
+        count, left_over = divmod(getsize(filename), ciphertext_size)
+        if left_over:
+            raise ValueError("Truncated ciphertexts file!")
+
+        # mmap() of an empty file is not possible
+        if count:
+            self.array = np.memmap(filename, dtype=np.uint8, mode="r",
+                                   shape=(count, ciphertext_size))
+        else:
+            self.array = np.empty((0, ciphertext_size), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        return memoryview(self.array[index])
+
+
+def read_side_data(filename):
+    """Memory map the side data file, return an array of records."""
+    if not getsize(filename):
+        return np.empty(0, dtype=SIDE_DATA_DTYPE)
+    if getsize(filename) % SIDE_DATA_DTYPE.itemsize:
+        raise ValueError("Truncated side data file!")
+    return np.memmap(filename, dtype=SIDE_DATA_DTYPE, mode="r")
+
+
+def read_key_index(filename):
+    """Memory map the key index file, return an array of key indexes."""
+    if not getsize(filename):
+        return np.empty(0, dtype=KEY_INDEX_DTYPE)
+    if getsize(filename) % KEY_INDEX_DTYPE.itemsize:
+        raise ValueError("Truncated key index file!")
+    return np.memmap(filename, dtype=KEY_INDEX_DTYPE, mode="r")
+
+
+class PreparedKey(object):
+    """
+    ML-KEM decapsulation key with the parts that don't depend on the
+    ciphertext already decoded.
+
+    Keeps both the kyber-py objects, used by the reference implementation
+    in extract.py, and NumPy arrays, used by the batch functions.
+    The kyber-py objects must not be modified.
+    """
+
+    def __init__(self, kem, dk):
+        if len(dk) != kem._dk_size():
+            raise ValueError("wrong decapsulation key length")
+
+        self.kem = kem
+        self.dk = dk
+        self.dk_pke = dk[0:384 * kem.k]
+        self.ek_pke = dk[384 * kem.k : 768 * kem.k + 32]
+        self.h = dk[768 * kem.k + 32 : 768 * kem.k + 64]
+        self.z = dk[768 * kem.k + 64 :]
+
+        if kem._H(self.ek_pke) != self.h:
+            raise ValueError("hash check of decapsulation key failed")
+
+        t_hat_bytes, rho = self.ek_pke[:-32], self.ek_pke[-32:]
+
+        self.s_hat = kem.M.decode_vector(self.dk_pke, kem.k, 12, is_ntt=True)
+        self.t_hat = kem.M.decode_vector(t_hat_bytes, kem.k, 12, is_ntt=True)
+        if self.t_hat.encode(12) != t_hat_bytes:
+            raise ValueError("modulus check of encapsulation key failed")
+        self.a_hat_t = kem._generate_matrix_from_seed(rho, transpose=True)
+
+        self.s_hat_array = np.array(
+            [self.s_hat[i, 0].coeffs for i in range(kem.k)], dtype=np.int64)
+        self.t_hat_array = np.array(
+            [self.t_hat[i, 0].coeffs for i in range(kem.k)], dtype=np.int64)
+        self.a_hat_t_array = np.array(
+            [[self.a_hat_t[i, j].coeffs for j in range(kem.k)]
+             for i in range(kem.k)], dtype=np.int64)
+
+
+def k_pke_encrypt_batch(key, m, r):
+    """
+    Encrypt messages m using randomness r, one row per message.
+
+    Uses the encryption key that is part of the prepared decapsulation key.
+    """
+    kem = key.kem
+    k = kem.k
+    seeds = [bytes(i) for i in r]
+
+    y = np.stack([_prf_cbd(kem, seeds, kem.eta_1, i) for i in range(k)],
+                 axis=1)
+    e1 = np.stack([_prf_cbd(kem, seeds, kem.eta_2, k + i) for i in range(k)],
+                  axis=1)
+    e2 = _prf_cbd(kem, seeds, kem.eta_2, 2 * k)
+
+    y_hat = ntt(y)
+
+    u = intt(ntt_dot(key.a_hat_t_array[None, :, :, :],
+                     y_hat[:, None, :, :]))
+    u = (u + e1) % Q
+
+    mu = decompress(byte_decode(m, 1), 1)[:, 0, :]
+    v = (intt(ntt_dot(key.t_hat_array[None, :, :], y_hat)) + e2 + mu) % Q
+
+    c1 = byte_encode(compress(u, kem.du), kem.du)
+    c2 = byte_encode(compress(v[:, None, :], kem.dv), kem.dv)
+
+    return np.concatenate([c1, c2], axis=1)
+
+
+def _u_and_v(key, c):
+    """Return the compressed u and v polynomials of every ciphertext."""
+    kem = key.kem
+    n = kem.k * kem.du * 32
+    return (byte_decode(c[:, :n], kem.du),
+            byte_decode(c[:, n:], kem.dv)[:, 0, :])
+
+
+def _u_hat(key, c, counts=None):
+    """Return NTT(u) for every ciphertext in c."""
+    kem = key.kem
+    return ntt(decompress(_u_and_v(key, c)[0], kem.du), counts)
+
+
+def _w(key, c, s_hat_dot_u_hat, counts=None):
+    """Return w = v - s^T . u for every ciphertext in c."""
+    kem = key.kem
+    v = decompress(_u_and_v(key, c)[1], kem.dv)
+    return (v - intt(s_hat_dot_u_hat, counts)) % Q
+
+
+def k_pke_decrypt_batch(key, c):
+    """Decrypt the ciphertexts c (one per row) with the prepared key."""
+    s_hat_dot_u_hat = ntt_dot(key.s_hat_array[None, :, :], _u_hat(key, c))
+    w = _w(key, c, s_hat_dot_u_hat)
+    return byte_encode(compress(w[:, None, :], 1), 1)
+
+
+# intermediate values of decapsulation, in the order in which they are
+# calculated, every one requires calculation of all the previous ones
+INTERMEDIATES = ("c", "u_hat", "s_hat_dot_u_hat", "w", "m_prime", "r_prime",
+                 "c_prime")
+
+# metrics calculated from the intermediate values,
+# name: (needs, function, dtype)
+ML_KEM_METRICS = dict()
+
+
+def ml_kem_metric(name, needs, dtype="<i2"):
+    """
+    Register a function calculating a metric of intermediate values.
+
+    The function is called with a dictionary with the ciphertexts ("c"),
+    the prepared key ("key" and "kem"), the intermediate values up to and
+    including needs, and the counts of the NTT of u ("ntt-u-counts") and
+    of the inverse NTT calculating w ("intt-counts"). It must return an
+    array with one value per ciphertext.
+
+    dtype is the smallest integer type that can hold all values of the
+    metric for every parameter set, used when the values are stored.
+    """
+    if needs not in INTERMEDIATES:
+        raise ValueError("Unknown intermediate value: {0}".format(needs))
+
+    def register(func):
+        ML_KEM_METRICS[name] = (needs, func, np.dtype(dtype))
+        return func
+    return register
+
+
+@ml_kem_metric("hw-m-prime", needs="m_prime")
+def _hw_m_prime(values):
+    return hamming_weight(values["m_prime"]).sum(axis=1)
+
+
+@ml_kem_metric("hw-r-prime", needs="r_prime")
+def _hw_r_prime(values):
+    return hamming_weight(values["r_prime"]).sum(axis=1)
+
+
+@ml_kem_metric("hw-w", needs="w")
+def _hw_w(values):
+    return hamming_weight(values["w"]).sum(axis=1)
+
+
+@ml_kem_metric("bit-size-w", needs="w")
+def _bit_size_w(values):
+    return bit_size(values["w"]).sum(axis=1)
+
+
+@ml_kem_metric("hw-s-hat-dot-u-hat", needs="s_hat_dot_u_hat")
+def _hw_s_hat_dot_u_hat(values):
+    return hamming_weight(values["s_hat_dot_u_hat"]).sum(axis=1)
+
+
+@ml_kem_metric("bit-size-s-hat-dot-u-hat", needs="s_hat_dot_u_hat")
+def _bit_size_s_hat_dot_u_hat(values):
+    return bit_size(values["s_hat_dot_u_hat"]).sum(axis=1)
+
+
+@ml_kem_metric("bit-size-min-w", needs="w")
+def _bit_size_min_w(values):
+    return bit_size(values["w"]).min(axis=1)
+
+
+@ml_kem_metric("reductions-ntt-u", needs="u_hat")
+def _reductions_ntt_u(values):
+    return values["ntt-u-counts"]["reductions"].sum(axis=1)
+
+
+@ml_kem_metric("zeros-ntt-u", needs="u_hat")
+def _zeros_ntt_u(values):
+    return values["ntt-u-counts"]["zeros"].sum(axis=1)
+
+
+@ml_kem_metric("reductions-intt-s-hat-dot-u-hat", needs="w")
+def _reductions_intt_s_hat_dot_u_hat(values):
+    return values["intt-counts"]["reductions"]
+
+
+@ml_kem_metric("zeros-intt-s-hat-dot-u-hat", needs="w")
+def _zeros_intt_s_hat_dot_u_hat(values):
+    return values["intt-counts"]["zeros"]
+
+
+@ml_kem_metric("bit-size-decompress-u", needs="c")
+def _bit_size_decompress_u(values):
+    # sizes of the products rounded by the shift in Decompress
+    d = values["kem"].du
+    u = _u_and_v(values["key"], values["c"])[0]
+    return bit_size(Q * u + (1 << (d - 1))).sum(axis=(1, 2))
+
+
+@ml_kem_metric("bit-size-decompress-v", needs="c")
+def _bit_size_decompress_v(values):
+    d = values["kem"].dv
+    v = _u_and_v(values["key"], values["c"])[1]
+    return bit_size(Q * v + (1 << (d - 1))).sum(axis=1)
+
+
+@ml_kem_metric("bit-size-compress-w", needs="w")
+def _bit_size_compress_w(values):
+    # sizes of the dividends of the division by q in Compress (KyberSlash)
+    return bit_size((values["w"] << 1) + Q // 2).sum(axis=1)
+
+
+@ml_kem_metric("hw-c-prime", needs="c_prime")
+def _hw_c_prime(values):
+    return hamming_weight(values["c_prime"]).sum(axis=1)
+
+
+@ml_kem_metric("hd-c-c-prime", needs="c_prime")
+def _hd_c_c_prime(values):
+    return hamming_weight(values["c"] ^ values["c_prime"]).sum(axis=1)
+
+
+@ml_kem_metric("first-diff-c-c-prime", needs="c_prime")
+def _first_diff_c_c_prime(values):
+    return _first_and_last_difference(values["c"], values["c_prime"])[0]
+
+
+@ml_kem_metric("last-diff-c-c-prime", needs="c_prime")
+def _last_diff_c_c_prime(values):
+    return _first_and_last_difference(values["c"], values["c_prime"])[1]
+
+
+def ml_kem_decaps_batch(key, c, side_data=None, metrics=None):
+    """
+    Perform ML-KEM decapsulation of multiple ciphertexts at once.
+
+    key is a PreparedKey, c is a (number of ciphertexts, ciphertext size)
+    array of uint8.
+
+    side_data is an optional array of SIDE_DATA_DTYPE records, one for every
+    ciphertext. Ciphertexts with known encapsulated message are not
+    re-encrypted if they decrypt to it, as they are valid ciphertexts.
+
+    metrics is a list of names of metrics from ML_KEM_METRICS to calculate,
+    all of them by default. Only the intermediate values needed by them are
+    calculated.
+
+    Returns a (number of ciphertexts, 32) array of shared secrets and a
+    dictionary with arrays of the selected metrics. The metrics calculated
+    also by Extract._ml_kem_decaps_with_intermediates() have the same
+    values.
+    If the metrics don't need re-encryption, only the shared secrets of
+    ciphertexts with known message are calculated (the rest are zero), or,
+    without side data, None is returned instead of shared secrets.
+    """
+    kem = key.kem
+    c = np.asarray(c, dtype=np.uint8)
+
+    if c.ndim != 2 or c.shape[1] != 32 * (kem.du * kem.k + kem.dv):
+        raise ValueError("wrong ciphertext length")
+
+    if metrics is None:
+        metrics = list(ML_KEM_METRICS)
+    for name in metrics:
+        if name not in ML_KEM_METRICS:
+            raise ValueError("Unknown ML-KEM metric: {0}".format(name))
+
+    needs = [ML_KEM_METRICS[name][0] for name in metrics]
+    if side_data is not None:
+        # to verify the shared secrets
+        needs.append("r_prime")
+    last = max(INTERMEDIATES.index(i) for i in needs) if needs else -1
+
+    values = {"c": c, "key": key, "kem": kem}
+    shared_secrets = None
+
+    if last >= INTERMEDIATES.index("u_hat"):
+        values["ntt-u-counts"] = dict()
+        values["u_hat"] = _u_hat(key, c, values["ntt-u-counts"])
+
+    if last >= INTERMEDIATES.index("s_hat_dot_u_hat"):
+        values["s_hat_dot_u_hat"] = ntt_dot(key.s_hat_array[None, :, :],
+                                            values["u_hat"])
+
+    if last >= INTERMEDIATES.index("w"):
+        values["intt-counts"] = dict()
+        values["w"] = _w(key, c, values["s_hat_dot_u_hat"],
+                         values["intt-counts"])
+
+    if last >= INTERMEDIATES.index("m_prime"):
+        values["m_prime"] = byte_encode(compress(values["w"][:, None, :], 1),
+                                        1)
+
+    if last >= INTERMEDIATES.index("r_prime"):
+        k_and_r = [kem._G(bytes(m) + key.h) for m in values["m_prime"]]
+        values["k_prime"] = np.frombuffer(b"".join(i for i, _ in k_and_r),
+                                          dtype=np.uint8).reshape(-1, 32)
+        values["r_prime"] = np.frombuffer(b"".join(i for _, i in k_and_r),
+                                          dtype=np.uint8).reshape(-1, 32)
+
+    if side_data is not None:
+        known = (side_data["flags"] & SIDE_DATA_KNOWN) != 0
+        # re-encryption of a valid ciphertext gives the same ciphertext
+        same = known & (side_data["m"] == values["m_prime"]).all(axis=1)
+        reencrypt = ~same
+        rejected = known & ~same
+    else:
+        same = np.zeros(len(c), dtype=bool)
+        reencrypt = ~same
+        rejected = same
+
+    if last >= INTERMEDIATES.index("c_prime"):
+        c_prime = c.copy()
+        c_prime[reencrypt] = k_pke_encrypt_batch(
+            key, values["m_prime"][reencrypt], values["r_prime"][reencrypt])
+        values["c_prime"] = c_prime
+        same = (c == c_prime).all(axis=1)
+        rejected = ~same
+
+    if "c_prime" in values or side_data is not None:
+        shared_secrets = np.zeros((len(c), 32), dtype=np.uint8)
+        shared_secrets[same] = values["k_prime"][same]
+        shared_secrets[rejected] = np.frombuffer(
+            b"".join(kem._J(key.z + bytes(i)) for i in c[rejected]),
+            dtype=np.uint8).reshape(-1, 32)
+
+    return shared_secrets, dict((name, ML_KEM_METRICS[name][1](values))
+                                for name in metrics)
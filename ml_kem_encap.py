@@ -3,10 +3,14 @@ import sys
 import getopt
 import ecdsa.der as der
 import random
+import hashlib
+import multiprocessing as mp
 from threading import Thread, Event
+import numpy as np
 from kyber_py.ml_kem.pkcs import ek_from_pem
 from tlsfuzzer.utils.log import Log
 from tlsfuzzer.utils.progress_report import progress_report
+from ml_kem_batch import SIDE_DATA_DTYPE, SIDE_DATA_KNOWN, KEY_INDEX_DTYPE
 
 
 if sys.version_info < (3, 8):
@@ -14,9 +18,54 @@ if sys.version_info < (3, 8):
     sys.exit(1)
 
 
+# number of ciphertexts generated by a worker in one go
+CHUNK_SIZE = 1000
+
+
+class ProbeDRBG(object):
+    """
+    Deterministic source of randomness for generating a single ciphertext.
+
+    The output is SHAKE-256 of the seed, the probe name and the index of
+    the ciphertext, so any ciphertext can be regenerated independently of
+    all the other ones.
+    """
+
+    def __init__(self, seed, probe_name, index):
+        name = probe_name.encode("utf-8")
+        self._xof = hashlib.shake_256(
+            len(seed).to_bytes(4, "big") + seed +
+            len(name).to_bytes(4, "big") + name +
+            index.to_bytes(8, "big"))
+        self._used = 0
+
+    def randbytes(self, n):
+        """Return next n bytes of the output."""
+        data = self._xof.digest(self._used + n)[self._used:]
+        self._used += n
+        return data
+
+    def randint(self, a, b):
+        """Return a random integer N such that a <= N <= b."""
+        width = b - a
+        bits = width.bit_length()
+        while True:
+            value = int.from_bytes(self.randbytes((bits + 7) // 8), "big")
+            value &= (1 << bits) - 1
+            if value <= width:
+                return a + value
+
+
 class CiphertextGenerator(object):
     """
     Class for generating different kinds of ML-KEM ciphertexts.
+
+    rng is the source of randomness for the ciphertexts, the random module
+    (and os.urandom() for the encapsulated messages) by default.
+
+    side_data is set to the encapsulated message and the shared secret
+    by probes that create ciphertexts that decapsulate to them, it's None
+    after other probes.
     """
 
     types = {}
@@ -24,6 +73,21 @@ class CiphertextGenerator(object):
     def __init__(self, kem, public_key):
         self.kem = kem
         self.key = public_key
+        self.rng = random
+        self.side_data = None
+
+    def _encaps(self):
+        """
+        Encapsulate a random message with the public key.
+
+        Returns the message, the shared secret and the ciphertext.
+        """
+        if self.rng is random:
+            m = os.urandom(32)
+        else:
+            m = self.rng.randbytes(32)
+        shared_secret, encaps = self.kem._encaps_internal(self.key, m)
+        return m, shared_secret, encaps
 
     types["valid"] = 1
 
@@ -33,7 +97,8 @@ class CiphertextGenerator(object):
 
         gen_id is just to have ability to have duplicate generators
         """
-        _, encaps = self.kem.encaps(self.key)
+        m, shared_secret, encaps = self._encaps()
+        self.side_data = (m, shared_secret)
         return encaps
 
     types["random"] = 1
@@ -47,7 +112,7 @@ class CiphertextGenerator(object):
         gen_id is just to have the ability to have duplicate generators
         """
         cipher_bytes = 32 * (self.kem.du * self.kem.k + self.kem.dv)
-        return random.randbytes(cipher_bytes)
+        return self.rng.randbytes(cipher_bytes)
 
     types["xor_u_coefficient"] = 2
 
@@ -67,7 +132,7 @@ class CiphertextGenerator(object):
         assert val < 2 ** self.kem.du
         if pos < 0:
             pos %= self.kem.k * 256
-        _, encaps = self.kem.encaps(self.key)
+        _, _, encaps = self._encaps()
 
         n = self.kem.k * self.kem.du * 32
         c1, c2 = encaps[:n], encaps[n:]
@@ -95,7 +160,7 @@ class CiphertextGenerator(object):
         assert val > 0
         assert val < 2 ** self.kem.dv
 
-        _, encaps = self.kem.encaps(self.key)
+        _, _, encaps = self._encaps()
 
         n = self.kem.k * self.kem.du * 32
         c1, c2 = encaps[:n], encaps[n:]
@@ -120,9 +185,9 @@ class CiphertextGenerator(object):
 
         u = bytearray(self.kem.k * self.kem.du * 32)
         u[pos * self.kem.du * 32:(pos+1) * self.kem.du * 32] = \
-            random.randbytes(self.kem.du * 32)
+            self.rng.randbytes(self.kem.du * 32)
 
-        v = random.randbytes(self.kem.dv * 32)
+        v = self.rng.randbytes(self.kem.dv * 32)
 
         return bytes(u + v)
 
@@ -138,10 +203,10 @@ class CiphertextGenerator(object):
         assert pos >= -256
         assert pos <= 255
 
-        u = random.randbytes(self.kem.k * self.kem.du * 32)
+        u = self.rng.randbytes(self.kem.k * self.kem.du * 32)
 
         v = self.kem.R.decode(bytes(self.kem.dv * 32), self.kem.dv)
-        v.coeffs[pos] = random.randint(0, 2 ** self.kem.dv - 1)
+        v.coeffs[pos] = self.rng.randint(0, 2 ** self.kem.dv - 1)
 
         cx = v.encode(self.kem.dv)
 
@@ -156,14 +221,31 @@ def help_msg():
 Generate ciphertexts for testing ML-KEM decapsulation interface against
 timing side-channel.
 
--c key.pem       Path to PEM-encoded ML-KEM encapsulation key.
+-c key.pem       Path to PEM-encoded ML-KEM encapsulation key. Can be
+                 repeated to encapsulate to multiple keys of the same
+                 parameter set, see --repeat.
 -o dir           Directory that will contain the generated ciphertexts.
                  "ciphertexts" by default.
 --describe=name  Describe the specified probe
 --repeat=num     Save the ciphertexts in random order in a single file
                  (ciphers.bin) in the specified directory together with a
                  file specifying the order (log.csv). Used for generating
-                 input file for timing tests.
+                 input file for timing tests. With multiple keys, every
+                 ciphertext uses a key picked at random and key_index.bin
+                 has the position of its key on the command line, as
+                 a little-endian 16 bit integer for every ciphertext.
+--workers=num    Number of worker processes to use for generating the
+                 repeated probes. 1 by default.
+--seed=string    Generate the repeated probes deterministically. Every
+                 ciphertext is derived from the seed, the probe name and
+                 its position in ciphers.bin, so the same ciphers.bin is
+                 generated for the same log.csv, independently of the
+                 number of workers used.
+--side-data      Write also side_data.bin with a fixed-size record for
+                 every ciphertext in ciphers.bin: the index of the probe
+                 in log.csv and, for the valid probes, the encapsulated
+                 message and the shared secret. Used by extract.py to
+                 skip re-encryption and to verify the shared secrets.
 --force          Don't abort when the output dir exists
 --verbose        Print status progress when generating repeated probes
 --help           This message
@@ -174,11 +256,107 @@ Supported probes:
     i, j) for i, j in CiphertextGenerator.types.items())))
 
 
-def gen_timing_probes(out_dir, pub, kem, args, repeat, verbose=False):
-    generator = CiphertextGenerator(kem, pub)
+def _generate_chunk(generator, probes, seed, out, side_out, ciphertext_size,
+                    start, indexes, keys=None, key_index_out=None):
+    """
+    Generate ciphertexts for the probes with given indexes and write them
+    to the out file, starting at ciphertext number start.
+
+    When seed is set, every ciphertext is generated with its own ProbeDRBG,
+    seeded with the probe name and the position of the ciphertext in the
+    file.
+
+    When side_out is set, a SIDE_DATA_DTYPE record is written to it for
+    every ciphertext.
+
+    When key_index_out is set, every ciphertext is encapsulated to a key
+    picked at random from keys, and its index is written to key_index_out.
+    """
+    ciphertexts = []
+    side_data = np.zeros(len(indexes), dtype=SIDE_DATA_DTYPE)
+    key_index = np.zeros(len(indexes), dtype=KEY_INDEX_DTYPE)
+    for position, index in enumerate(indexes, start):
+        p_name, p_method, p_params = probes[index]
+        if seed is not None:
+            generator.rng = ProbeDRBG(seed, p_name, position)
+        if key_index_out:
+            key_index[position - start] = generator.rng.randint(
+                0, len(keys) - 1)
+            generator.key = keys[key_index[position - start]]
+        generator.side_data = None
+        ciphertexts.append(p_method(*p_params))
+
+        record = side_data[position - start]
+        record["probe"] = index
+        if generator.side_data:
+            m, shared_secret = generator.side_data
+            record["flags"] = SIDE_DATA_KNOWN
+            record["m"] = np.frombuffer(m, dtype=np.uint8)
+            record["K"] = np.frombuffer(shared_secret, dtype=np.uint8)
+
+    data = b"".join(ciphertexts)
+    if len(data) != ciphertext_size * len(indexes):
+        raise ValueError("Probe generated a ciphertext of unexpected size")
+
+    out.seek(start * ciphertext_size)
+    out.write(data)
+    out.flush()
+
+    if side_out:
+        side_out.seek(start * SIDE_DATA_DTYPE.itemsize)
+        side_out.write(side_data.tobytes())
+        side_out.flush()
+
+    if key_index_out:
+        key_index_out.seek(start * KEY_INDEX_DTYPE.itemsize)
+        key_index_out.write(key_index.tobytes())
+        key_index_out.flush()
+
+    return len(indexes)
+
+
+# state of the worker processes, set up by _worker_init()
+_worker = {}
+
+
+def _worker_init(kem, keys, probe_specs, seed, out_name, side_name,
+                 key_index_name):
+    """Set up the generator and open the output file in a worker process."""
+    # don't use the random state inherited from the parent process
+    random.seed()
+
+    generator = CiphertextGenerator(kem, keys[0])
+    _worker["generator"] = generator
+    _worker["probes"] = [(p_name, getattr(generator, name), params)
+                         for p_name, name, params in probe_specs]
+    _worker["seed"] = seed
+    _worker["ciphertext_size"] = 32 * (kem.du * kem.k + kem.dv)
+    _worker["out"] = open(out_name, "r+b")
+    _worker["side_out"] = open(side_name, "r+b") if side_name else None
+    _worker["keys"] = keys
+    _worker["key_index_out"] = \
+        open(key_index_name, "r+b") if key_index_name else None
+
+
+def _worker_generate_chunk(chunk):
+    """Generate a chunk of ciphertexts in a worker process."""
+    start, indexes = chunk
+    return _generate_chunk(_worker["generator"], _worker["probes"],
+                           _worker["seed"], _worker["out"],
+                           _worker["side_out"], _worker["ciphertext_size"],
+                           start, indexes, _worker["keys"],
+                           _worker["key_index_out"])
+
+
+def gen_timing_probes(out_dir, pub, kem, args, repeat, verbose=False,
+                      workers=1, seed=None, side_data=False):
+    # pub is a single encapsulation key or a list of them
+    keys = pub if isinstance(pub, list) else [pub]
+    generator = CiphertextGenerator(kem, keys[0])
 
     probes = {}
     probe_names = []
+    probe_specs = []
 
     # parse the parameters
     for arg in args:
@@ -212,6 +390,11 @@ def gen_timing_probes(out_dir, pub, kem, args, repeat, verbose=False):
 
         probes[probe_name] = (method, params)
         probe_names.append(probe_name)
+        probe_specs.append((probe_name, name, params))
+
+    # the probe order is shuffled using the random module
+    if seed is not None:
+        random.seed(seed)
 
     # create an order in which we will write the ciphertexts in
     log = Log(os.path.join(out_dir, "log.csv"))
@@ -226,6 +409,32 @@ def gen_timing_probes(out_dir, pub, kem, args, repeat, verbose=False):
     # reset the log position
     log.read_log()
 
+    order = list(log.iterate_log())
+
+    ciphertext_size = 32 * (kem.du * kem.k + kem.dv)
+    out_name = os.path.join(out_dir, "ciphers.bin")
+
+    side_name = None
+    if side_data:
+        side_name = os.path.join(out_dir, "side_data.bin")
+
+    key_index_name = None
+    if len(keys) > 1:
+        key_index_name = os.path.join(out_dir, "key_index.bin")
+
+    # preallocate the files so that the chunks can be written out of order
+    with open(out_name, "wb") as out:
+        out.truncate(len(order) * ciphertext_size)
+    if side_name:
+        with open(side_name, "wb") as side_out:
+            side_out.truncate(len(order) * SIDE_DATA_DTYPE.itemsize)
+    if key_index_name:
+        with open(key_index_name, "wb") as key_index_out:
+            key_index_out.truncate(len(order) * KEY_INDEX_DTYPE.itemsize)
+
+    chunks = ((start, order[start:start + CHUNK_SIZE])
+              for start in range(0, len(order), CHUNK_SIZE))
+
     try:
         # start progress reporting
         status = [0, len(probe_names) * repeat, Event()]
@@ -237,17 +446,32 @@ def gen_timing_probes(out_dir, pub, kem, args, repeat, verbose=False):
                               kwargs=kwargs)
             progress.start()
 
-        with open(os.path.join(out_dir, "ciphers.bin"), "wb") as out:
-            # start the ciphertext generation
-            for executed, index in enumerate(log.iterate_log()):
-                status[0] = executed
-
-                p_name = probe_names[index]
-                p_method, p_params = probes[p_name]
-
-                ciphertext = p_method(*p_params)
-
-                out.write(ciphertext)
+        if workers == 1:
+            ordered_probes = [(i,) + probes[i] for i in probe_names]
+            out = open(out_name, "r+b")
+            side_out = open(side_name, "r+b") if side_name else None
+            key_index_out = \
+                open(key_index_name, "r+b") if key_index_name else None
+            try:
+                for start, indexes in chunks:
+                    status[0] += _generate_chunk(
+                        generator, ordered_probes, seed, out, side_out,
+                        ciphertext_size, start, indexes, keys,
+                        key_index_out)
+            finally:
+                out.close()
+                if side_out:
+                    side_out.close()
+                if key_index_out:
+                    key_index_out.close()
+        else:
+            with mp.Pool(workers, initializer=_worker_init,
+                         initargs=(kem, keys, probe_specs, seed,
+                                   out_name, side_name,
+                                   key_index_name)) as pool:
+                for count in pool.imap_unordered(_worker_generate_chunk,
+                                                 chunks):
+                    status[0] += count
     finally:
         if verbose:
             status[2].set()
@@ -259,20 +483,31 @@ def gen_timing_probes(out_dir, pub, kem, args, repeat, verbose=False):
 
 
 if __name__ == "__main__":
-    key = None
+    keys = []
     kem = None
     out_dir = "ciphertexts"
     repeat = None
     force_dir = False
     verbose = False
+    workers = 1
+    seed = None
+    side_data = False
 
     argv = sys.argv[1:]
     opts, args = getopt.getopt(argv, "c:o:", ["help", "describe=", "repeat=",
-                                              "force", "verbose"])
+                                              "force", "verbose",
+                                              "workers=", "seed=",
+                                              "side-data"])
     for opt, arg in opts:
         if opt == "-c":
             with open(arg, "r") as key_fd:
-                kem, key = ek_from_pem(key_fd.read())
+                key_kem, key = ek_from_pem(key_fd.read())
+            if kem and key_kem is not kem:
+                print("ERROR: Encapsulation keys of different parameter "
+                      "sets specified", file=sys.stderr)
+                sys.exit(1)
+            kem = key_kem
+            keys.append(key)
         elif opt == "-o":
             out_dir = arg
         elif opt == "--help":
@@ -284,6 +519,12 @@ if __name__ == "__main__":
             repeat = int(arg)
         elif opt == "--verbose":
             verbose = True
+        elif opt == "--workers":
+            workers = int(arg)
+        elif opt == "--seed":
+            seed = arg.encode("utf-8")
+        elif opt == "--side-data":
+            side_data = True
         elif opt == "--describe":
             try:
                 fun = getattr(CiphertextGenerator, arg)
@@ -300,10 +541,14 @@ if __name__ == "__main__":
         print("ERROR: No ciphertexts specified", file=sys.stderr)
         sys.exit(1)
 
-    if not key:
+    if not keys:
         print("ERROR: No encapsulation key specified", file=sys.stderr)
         sys.exit(1)
 
+    if workers <= 0:
+        print("ERROR: workers must be a positive integer", file=sys.stderr)
+        sys.exit(1)
+
     if repeat is not None and repeat <= 0:
         print("ERROR: repeat must be a positive integer", file=sys.stder)
         sys.exit(1)
@@ -319,8 +564,9 @@ if __name__ == "__main__":
             raise
 
     if repeat is None:
-        single_shot(out_dir, key, kem, args)
+        single_shot(out_dir, keys[0], kem, args)
     else:
-        gen_timing_probes(out_dir, key, kem, args, repeat, verbose)
+        gen_timing_probes(out_dir, keys, kem, args, repeat, verbose, workers,
+                          seed, side_data)
 
     print("done")
@@ -0,0 +1,643 @@
+"""
+Common interface of the ML-KEM decapsulation timing harnesses.
+
+A harness reads the ciphertexts file, the PEM file with the decapsulation
+keys and, optionally, the key index file written by ml_kem_encap.py, and
+writes the time of decapsulation of every ciphertext as a little-endian
+8 byte integer (extract.py --binary 8) or, in the in-process harnesses
+outside of batch mode, to a CSV file. It can also write the timer
+metadata read by extract.py --timer-metadata, and the sequence numbers and
+disturbances of the samples and canaries read by extract.py --sample-info
+and --canary-times.
+
+Implementations timed in this process need just an adapter returning the
+decapsulation function for every key, see KyberPyHarness and
+CtypesHarness. External programs with the command line interface of
+harness/openssl/time_decapsulate are run by SubprocessHarness.
+"""
+
+import abc
+import sys
+import csv
+import json
+import time
+import resource
+import ctypes
+import getopt
+import subprocess
+from array import array
+from functools import partial
+
+
+# number of measurements of an empty timed region for the timer metadata
+OVERHEAD_SAMPLES = 100000
+
+
+def read_keys(key_file):
+    """Return the KEM and the list of decapsulation keys from the PEM file."""
+    from kyber_py.ml_kem.pkcs import dk_from_pem
+
+    end = "-----END PRIVATE KEY-----"
+    with open(key_file, "r") as key_fd:
+        blocks = key_fd.read().split(end)[:-1]
+
+    kem = None
+    keys = []
+    for block in blocks:
+        key_kem, dk, _, _ = dk_from_pem(block + end)
+        if kem and key_kem is not kem:
+            raise ValueError("Keys of different parameter sets in {0}"
+                             .format(key_file))
+        kem = key_kem
+        keys.append(dk)
+
+    if not keys:
+        raise ValueError("No private key in {0}".format(key_file))
+    return kem, keys
+
+
+def read_ciphertexts(ciphers_file, ciphertext_size):
+    """Return the list of ciphertexts from the ciphertexts file."""
+    with open(ciphers_file, "rb") as in_fd:
+        data = in_fd.read()
+    if len(data) % ciphertext_size:
+        raise ValueError("Truncated ciphertexts file!")
+    return [data[i:i + ciphertext_size]
+            for i in range(0, len(data), ciphertext_size)]
+
+
+def read_key_index(key_index_file):
+    """Return the array of key indexes from the key index file."""
+    key_index = array("H")
+    with open(key_index_file, "rb") as key_index_fd:
+        key_index.frombytes(key_index_fd.read())
+    if sys.byteorder == "big":
+        key_index.byteswap()
+    return key_index
+
+
+def find_canary(log_file, canary_class):
+    """
+    Return the position of the first ciphertext of a class in the
+    ciphertexts file.
+
+    log_file is the log.csv written by ml_kem_encap.py, with the names of
+    the classes in the header and the column numbers of the classes in
+    the order of the ciphertexts in the rows. canary_class is the name of
+    the class or the number of its column.
+    """
+    with open(log_file, "r") as log_fd:
+        reader = csv.reader(log_fd)
+        classes = next(reader, [])
+        if canary_class in classes:
+            column = classes.index(canary_class)
+        elif canary_class.isdigit() and int(canary_class) < len(classes):
+            column = int(canary_class)
+        else:
+            raise ValueError("No class {0} in {1}"
+                             .format(canary_class, log_file))
+
+        position = 0
+        for row in reader:
+            for value in row:
+                if int(value) == column:
+                    return position
+                position += 1
+
+    raise ValueError("No ciphertext of class {0} in {1}"
+                     .format(canary_class, log_file))
+
+
+def write_times(out_file, times):
+    """Write an array('Q') of times as little-endian 8 byte integers."""
+    if sys.byteorder == "big":
+        times = array("Q", times)
+        times.byteswap()
+    with open(out_file, "wb") as out_fd:
+        times.tofile(out_fd)
+
+
+def context_switches():
+    """Return the number of context switches of this thread so far."""
+    usage = resource.getrusage(resource.RUSAGE_THREAD)
+    return usage.ru_nvcsw + usage.ru_nivcsw
+
+
+def overhead_statistics(samples):
+    """Return the distribution of the overhead samples, as in metadata."""
+    samples = sorted(samples)
+    count = len(samples)
+    return {"samples": count,
+            "mean": sum(samples) / count,
+            "min": samples[0],
+            "p1": samples[count // 100],
+            "p25": samples[count // 4],
+            "median": samples[count // 2],
+            "p75": samples[count // 4 * 3],
+            "p99": samples[count // 100 * 99],
+            "max": samples[-1]}
+
+
+class Harness(abc.ABC):
+    """Interface of a decapsulation timing harness."""
+
+    @abc.abstractmethod
+    def run(self, ciphers_file, key_file, out_file, ciphertext_size,
+            key_index_file=None, metadata_file=None, warm_up=0,
+            sample_info_file=None, canary_period=None, canary_file=None,
+            canary_index=0):
+        """
+        Measure decapsulation of all the ciphertexts.
+
+        :param str ciphers_file: file with concatenated ciphertexts
+        :param str key_file: file with concatenated PEM decapsulation keys
+        :param str out_file: file to write the times to
+        :param int ciphertext_size: size of a single ciphertext
+        :param str key_index_file: file with the index of the key of every
+            ciphertext, required with multiple keys
+        :param str metadata_file: file to write the timer metadata to,
+            None to skip measuring it
+        :param int warm_up: number of ciphertexts to decapsulate before
+            the measurements
+        :param str sample_info_file: file to write the sequence number and
+            number of disturbances of every ciphertext to, as two
+            little-endian 8 byte integers
+        :param int canary_period: measure the canary ciphertext again
+            before every canary_period ciphertexts
+        :param str canary_file: file to write the sequence number, time
+            and number of disturbances of every canary to, as three
+            little-endian 8 byte integers
+        :param int canary_index: position of the canary ciphertext in
+            ciphers_file, see find_canary()
+        """
+
+
+class CallableHarness(Harness):
+    """
+    Harness timing Python callables in this process.
+
+    Subclasses implement decapsulation_functions(), returning a function
+    decapsulating a ciphertext for every key, and can override check() to
+    verify the values the functions return.
+
+    In batch mode, all the ciphertexts are split before the first
+    measurement and the times are stored in a preallocated array, written
+    only after the last one. Otherwise the ciphertexts are read and the
+    times written to the "raw times" column of a CSV file one at a time.
+    The clock is time.monotonic_ns(), so its frequency is 1000 MHz.
+    The disturbances are the context switches of the measuring thread.
+    """
+
+    clock_frequency = 1000.0
+
+    def __init__(self, batch=True):
+        """:param bool batch: measure in batch mode"""
+        self.batch = batch
+
+    @abc.abstractmethod
+    def decapsulation_functions(self, key_file):
+        """Return a list of decapsulation functions, one for every key."""
+
+    def check(self, result):
+        """Verify the result of a decapsulation function."""
+        pass
+
+    def measure(self, functions, ciphertexts, key_index=None, warm_up=0,
+                sample_info=False, canary_period=None, canary_index=0):
+        """
+        Measure decapsulation of ciphertexts.
+
+        The first warm_up ciphertexts are decapsulated before the
+        measurements, the ciphertext at canary_index is measured again
+        before every canary_period ciphertexts.
+
+        Returns the array('Q') of times, the array('Q') with the sequence
+        number and disturbances of every ciphertext, if sample_info is set,
+        and the array('Q') with the sequence number, time and disturbances
+        of every canary, if canary_period is set.
+
+        The context switches are read once after the measurements, never
+        right before them, the disturbances of a measurement are the
+        difference from the previous reading.
+        """
+        times = array("Q", bytes(8 * len(ciphertexts)))
+        samples = None
+        if sample_info:
+            samples = array("Q", bytes(16 * len(ciphertexts)))
+        canaries = None
+        if canary_period:
+            canaries = array(
+                "Q", bytes(24 * (-(-len(ciphertexts) // canary_period))))
+        clock = time.monotonic_ns
+        check = self.check
+        function = functions[0]
+        canary_function = functions[0]
+        if key_index is not None and ciphertexts:
+            canary_function = functions[key_index[canary_index]]
+        disturbances = 0
+        sequence = 0
+
+        for position in range(warm_up if ciphertexts else 0):
+            position %= len(ciphertexts)
+            if key_index is not None:
+                function = functions[key_index[position]]
+            check(function(ciphertexts[position]))
+
+        if samples is not None or canaries is not None:
+            disturbances = context_switches()
+
+        for position, ciphertext in enumerate(ciphertexts):
+            if canaries is not None and position % canary_period == 0:
+                canary = 3 * (position // canary_period)
+
+                time_start = clock()
+
+                result = canary_function(ciphertexts[canary_index])
+
+                canaries[canary + 1] = clock() - time_start
+
+                reading = context_switches()
+                canaries[canary + 2] = reading - disturbances
+                disturbances = reading
+                canaries[canary] = sequence
+                sequence += 1
+                check(result)
+
+            if key_index is not None:
+                function = functions[key_index[position]]
+
+            time_start = clock()
+
+            result = function(ciphertext)
+
+            times[position] = clock() - time_start
+
+            if samples is not None:
+                reading = context_switches()
+                samples[2 * position + 1] = reading - disturbances
+                samples[2 * position] = sequence
+                disturbances = reading
+            elif canaries is not None and \
+                    (position + 1) % canary_period == 0:
+                # without the sample info only the next canary needs it
+                disturbances = context_switches()
+            sequence += 1
+
+            check(result)
+
+        return times, samples, canaries
+
+    def stream(self, functions, ciphers_file, out_file, ciphertext_size,
+               key_index=None):
+        """
+        Measure decapsulation of the ciphertexts read one at a time from
+        ciphers_file, write every time to out_file as soon as it's measured.
+        """
+        clock = time.monotonic_ns
+        check = self.check
+        function = functions[0]
+
+        with open(ciphers_file, "rb") as in_fd:
+            with open(out_file, "w") as out_fd:
+                out_fd.write("raw times\n")
+
+                position = 0
+                while True:
+                    ciphertext = in_fd.read(ciphertext_size)
+                    if not ciphertext:
+                        break
+
+                    if key_index is not None:
+                        if position >= len(key_index):
+                            raise ValueError("Key index file too short!")
+                        function = functions[key_index[position]]
+                    position += 1
+
+                    time_start = clock()
+
+                    result = function(ciphertext)
+
+                    diff = clock() - time_start
+
+                    out_fd.write("{0}\n".format(diff))
+                    check(result)
+
+    def metadata(self):
+        """Return the timer metadata, with the overhead of measure()."""
+        overhead = array("Q", bytes(8 * OVERHEAD_SAMPLES))
+        clock = time.monotonic_ns
+
+        for position in range(OVERHEAD_SAMPLES):
+            time_start = clock()
+            overhead[position] = clock() - time_start
+
+        return {"clock_frequency": self.clock_frequency,
+                "overhead": overhead_statistics(overhead)}
+
+    def run(self, ciphers_file, key_file, out_file, ciphertext_size,
+            key_index_file=None, metadata_file=None, warm_up=0,
+            sample_info_file=None, canary_period=None, canary_file=None,
+            canary_index=0):
+        if bool(canary_period) != bool(canary_file):
+            raise ValueError("Canary period and file must be used together!")
+        if not self.batch and (warm_up or sample_info_file or canary_period):
+            raise ValueError("Warm-up, sample info and canaries require "
+                             "batch mode!")
+
+        functions = self.decapsulation_functions(key_file)
+
+        key_index = None
+        if key_index_file:
+            key_index = read_key_index(key_index_file)
+            if max(key_index, default=0) >= len(functions):
+                raise ValueError("Key index refers to missing keys!")
+        elif len(functions) > 1:
+            raise ValueError("Multiple keys require a key index file!")
+
+        if metadata_file:
+            with open(metadata_file, "w") as metadata_fd:
+                json.dump(self.metadata(), metadata_fd, indent=4)
+
+        if not self.batch:
+            self.stream(functions, ciphers_file, out_file, ciphertext_size,
+                        key_index)
+            return
+
+        ciphertexts = read_ciphertexts(ciphers_file, ciphertext_size)
+        if key_index is not None and len(key_index) < len(ciphertexts):
+            raise ValueError("Key index file too short!")
+        if canary_period and ciphertexts and \
+                not 0 <= canary_index < len(ciphertexts):
+            raise ValueError("No ciphertext with the canary index!")
+
+        times, samples, canaries = self.measure(
+            functions, ciphertexts, key_index, warm_up,
+            bool(sample_info_file), canary_period, canary_index)
+
+        write_times(out_file, times)
+        if samples is not None:
+            write_times(sample_info_file, samples)
+        if canaries is not None:
+            write_times(canary_file, canaries)
+
+
+class KyberPyHarness(CallableHarness):
+    """Harness timing decapsulation by kyber-py."""
+
+    def decapsulation_functions(self, key_file):
+        kem, keys = read_keys(key_file)
+        return [partial(kem.decaps, dk) for dk in keys]
+
+
+class CtypesHarness(CallableHarness):
+    """
+    Harness timing decapsulation by a shared library.
+
+    The function must have the API of PQClean and liboqs:
+    int crypto_kem_dec(uint8_t *ss, const uint8_t *ct, const uint8_t *sk)
+    with the decapsulation key in the FIPS 203 format, and return 0 on
+    success.
+    """
+
+    def __init__(self, library, symbol="crypto_kem_dec", batch=True):
+        super(CtypesHarness, self).__init__(batch)
+        self.function = getattr(ctypes.CDLL(library), symbol)
+        self.function.argtypes = [ctypes.c_char_p] * 3
+        self.function.restype = ctypes.c_int
+        self.shared_secret = ctypes.create_string_buffer(32)
+
+    def decapsulation_functions(self, key_file):
+        _, keys = read_keys(key_file)
+        # keep the keys in buffers, so they are not converted every call
+        self.keys = [ctypes.create_string_buffer(dk, len(dk)) for dk in keys]
+        return [self._decapsulation_function(dk) for dk in self.keys]
+
+    def _decapsulation_function(self, dk):
+        function = self.function
+        shared_secret = self.shared_secret
+
+        def decaps(ciphertext):
+            return function(shared_secret, ciphertext, dk)
+        return decaps
+
+    def check(self, result):
+        if result != 0:
+            raise ValueError("Decapsulation failure: {0}".format(result))
+
+
+class SubprocessHarness(Harness):
+    """
+    Harness running an external program with the options of
+    harness/openssl/time_decapsulate:
+    -i ciphertexts -o times -k keys -n size [-x key index] [-m metadata]
+    [-w warm up] [-s sample info] [-c canary period -C canaries]
+    [-a canary index].
+    The program must write the times in binary format (e.g. with -b).
+    """
+
+    def __init__(self, command):
+        """:param list command: program and its additional options"""
+        self.command = list(command)
+
+    def run(self, ciphers_file, key_file, out_file, ciphertext_size,
+            key_index_file=None, metadata_file=None, warm_up=0,
+            sample_info_file=None, canary_period=None, canary_file=None,
+            canary_index=0):
+        command = self.command + ["-i", ciphers_file, "-o", out_file,
+                                  "-k", key_file,
+                                  "-n", str(ciphertext_size)]
+        if key_index_file:
+            command += ["-x", key_index_file]
+        if metadata_file:
+            command += ["-m", metadata_file]
+        if warm_up:
+            command += ["-w", str(warm_up)]
+        if sample_info_file:
+            command += ["-s", sample_info_file]
+        if canary_period:
+            command += ["-c", str(canary_period), "-C", canary_file]
+        if canary_index:
+            command += ["-a", str(canary_index)]
+        subprocess.run(command, check=True)
+
+
+def help_msg(batch=True):
+    if batch:
+        print("""
+ml_kem_harness.py -i file -o file -k file -n size [-x file] [-m file]
+                  [-w count] [-s file] [-c period -C file]
+                  [-a index | -l file -A class]
+                  [--library file [--symbol name]] [-- command]
+
+Measure decapsulation of ML-KEM ciphertexts, with kyber-py by default.
+The times are written in binary format, for extract.py --binary 8.
+""")
+    else:
+        print("""
+mlkem_decap.py -i file -o file -k file -n size [-x file] [-b] [-m file]
+               [-w count] [-s file] [-c period -C file]
+               [-a index | -l file -A class]
+               [--library file [--symbol name]] [-- command]
+
+Measure decapsulation of ML-KEM ciphertexts, with kyber-py by default.
+The times are written to the "raw times" column of a CSV file, one at a
+time, or in binary format in batch mode, for extract.py --binary 8.
+
+-b               Batch mode: read all the ciphertexts into memory before
+                 the measurements and write the times only after all of
+                 them. Required by -w, -s and -c
+""")
+    print("""-i file          File with the ciphertexts to decrypt
+-o file          File to write the timing data to
+-k file          File with the private key, or concatenated private keys
+                 when used with -x
+-n size          Size of individual ciphertexts (768, 1088 or 1568)
+-x file          Key index file (key_index.bin written by ml_kem_encap.py)
+-m file          Write the clock frequency and the overhead of the time
+                 measurement to file (extract.py --timer-metadata)
+-w count         Decapsulate count ciphertexts before the measurements,
+                 without recording the times
+-s file          Write the sequence number and the number of context
+                 switches during the measurement of every ciphertext to
+                 file (extract.py --sample-info). Costs a getrusage() call
+                 after every measurement, outside of the timed region, the
+                 switches since the previous measurement count too
+-c period        Measure the canary ciphertext again before every period
+                 ciphertexts
+-C file          File to write the sequence number, time and number of
+                 context switches of every canary to
+                 (extract.py --canary-times)
+-a index         Position of the canary ciphertext in the -i file, the
+                 first ciphertext by default
+-l file          Log file with the classes of the ciphertexts (log.csv
+                 written by ml_kem_encap.py), to pick the canary with -A
+-A class         Use the first ciphertext of class as the canary, the name
+                 of the class in the -l file or the number of its column
+--library file   Time the decapsulation function of the shared library,
+                 with the PQClean and liboqs crypto_kem_dec() API
+--symbol name    Name of the decapsulation function in the library,
+                 crypto_kem_dec by default
+-- command       Run command with the options of
+                 harness/openssl/time_decapsulate instead
+-h | --help      This message
+""")
+
+
+def main(argv=None, batch=True):
+    """
+    Command line interface of the harnesses.
+
+    :param list argv: the options, sys.argv[1:] by default
+    :param bool batch: measure in batch mode, otherwise only with -b
+    """
+    in_file = None
+    out_file = None
+    key_file = None
+    key_index_file = None
+    metadata_file = None
+    warm_up = 0
+    sample_info_file = None
+    canary_period = None
+    canary_file = None
+    canary_index = None
+    log_file = None
+    canary_class = None
+    read_size = None
+    library = None
+    symbol = "crypto_kem_dec"
+    options = "i:o:k:n:x:m:w:s:c:C:a:l:A:h"
+    if not batch:
+        options += "b"
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
+        help_msg(batch)
+        sys.exit(1)
+    opts, command = getopt.getopt(argv, options,
+                                  ["help", "library=", "symbol="])
+
+    for opt, arg in opts:
+        if opt == "-h" or opt == "--help":
+            help_msg(batch)
+            sys.exit(0)
+        elif opt == "-i":
+            in_file = arg
+        elif opt == "-o":
+            out_file = arg
+        elif opt == "-k":
+            key_file = arg
+        elif opt == "-n":
+            read_size = int(arg)
+        elif opt == "-x":
+            key_index_file = arg
+        elif opt == "-b":
+            batch = True
+        elif opt == "-m":
+            metadata_file = arg
+        elif opt == "-w":
+            warm_up = int(arg)
+        elif opt == "-s":
+            sample_info_file = arg
+        elif opt == "-c":
+            canary_period = int(arg)
+        elif opt == "-C":
+            canary_file = arg
+        elif opt == "-a":
+            canary_index = int(arg)
+        elif opt == "-l":
+            log_file = arg
+        elif opt == "-A":
+            canary_class = arg
+        elif opt == "--library":
+            library = arg
+        elif opt == "--symbol":
+            symbol = arg
+        else:
+            raise ValueError("Unrecognised parameter: {0} {1}"
+                             .format(opt, arg))
+
+    if not in_file or not out_file or not key_file or not read_size:
+        print("ERROR: -i, -o, -k and -n are required", file=sys.stderr)
+        sys.exit(1)
+
+    if library and command:
+        print("ERROR: --library and command are mutually exclusive",
+              file=sys.stderr)
+        sys.exit(1)
+
+    if bool(log_file) != bool(canary_class):
+        print("ERROR: -l and -A must be used together", file=sys.stderr)
+        sys.exit(1)
+
+    if canary_index is not None and canary_class:
+        print("ERROR: -a and -A are mutually exclusive", file=sys.stderr)
+        sys.exit(1)
+
+    if (canary_index is not None or canary_class) and not canary_period:
+        print("ERROR: -a and -A require canaries (-c)", file=sys.stderr)
+        sys.exit(1)
+
+    if command:
+        harness = SubprocessHarness(command)
+    elif library:
+        harness = CtypesHarness(library, symbol, batch)
+    else:
+        harness = KyberPyHarness(batch)
+
+    try:
+        if canary_class:
+            canary_index = find_canary(log_file, canary_class)
+
+        harness.run(in_file, key_file, out_file, read_size, key_index_file,
+                    metadata_file, warm_up, sample_info_file, canary_period,
+                    canary_file, canary_index or 0)
+    except ValueError as e:
+        print("ERROR: {0}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+    print("done")
+
+
+if __name__ == '__main__':
+    main()
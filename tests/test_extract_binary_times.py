@@ -0,0 +1,59 @@
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from extract import Extract
+
+
+class TestReadBinaryTimes(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.raw_times = os.path.join(self.tmpdir, "raw_times.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data):
+        with open(self.raw_times, "wb") as out_fp:
+            out_fp.write(data)
+
+    def test_times(self):
+        self.write(np.array([5, 6, 7], dtype="<u8").tobytes())
+        extract = Extract(raw_times=self.raw_times, binary=8)
+
+        self.assertEqual(list(extract._read_binary_times()), [5, 6, 7])
+
+    def test_counters(self):
+        self.write(np.array([5, 50, 500, 6, 60, 600],
+                            dtype="<u8").tobytes())
+        extract = Extract(raw_times=self.raw_times, binary=8,
+                          counters=("cycles", "instructions"))
+
+        self.assertEqual(list(extract._read_binary_times()), [5, 6])
+        self.assertEqual(list(extract._read_binary_times(2)), [500, 600])
+
+    def test_truncated_file(self):
+        self.write(np.array([5, 6, 7], dtype="<u8").tobytes()[:-1])
+        extract = Extract(raw_times=self.raw_times, binary=8)
+
+        with self.assertRaises(ValueError):
+            extract._read_binary_times()
+
+    def test_wrong_counters(self):
+        self.write(np.array([5, 50, 6, 60], dtype="<u8").tobytes())
+        extract = Extract(raw_times=self.raw_times, binary=8,
+                          counters=("cycles", "instructions"))
+
+        with self.assertRaises(ValueError):
+            extract._read_binary_times()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from tlsfuzzer.utils.log import Log
+
+from extract import Extract, SAMPLE_INFO_DTYPE, CANARY_DTYPE
+
+
+class TestDisturbedSamples(unittest.TestCase):
+    """
+    Samples with a canary measured before every 4 of them, as written by
+    the harnesses: canary, 4 samples, canary, 4 samples, canary, 2 samples.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sample_info = os.path.join(self.tmpdir, "sample_info.bin")
+        self.canary_times = os.path.join(self.tmpdir, "canaries.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, disturbances, canary_disturbances=(0, 0, 0),
+              canary_times=(100, 100, 100)):
+        info = np.zeros(len(disturbances), dtype=SAMPLE_INFO_DTYPE)
+        positions = np.arange(len(disturbances))
+        info["sequence"] = positions + 1 + positions // 4
+        info["disturbances"] = disturbances
+        info.tofile(self.sample_info)
+
+        canaries = np.zeros(len(canary_times), dtype=CANARY_DTYPE)
+        canaries["sequence"] = np.arange(len(canary_times)) * 5
+        canaries["time"] = canary_times
+        canaries["disturbances"] = canary_disturbances
+        canaries.tofile(self.canary_times)
+
+    def disturbed(self, count=10, **kwargs):
+        extract = Extract(sample_info=self.sample_info,
+                          canary_times=self.canary_times, **kwargs)
+        return list(np.flatnonzero(extract._disturbed_samples(count)))
+
+    def test_undisturbed(self):
+        self.write([0] * 10)
+
+        self.assertEqual(self.disturbed(), [])
+
+    def test_disturbed_sample(self):
+        self.write([0, 0, 1, 0, 0, 0, 0, 0, 0, 3])
+
+        self.assertEqual(self.disturbed(), [2, 9])
+
+    def test_max_disturbances(self):
+        self.write([0, 0, 1, 0, 0, 0, 0, 0, 0, 3], (0, 1, 0))
+
+        self.assertEqual(self.disturbed(max_disturbances=1), [9])
+
+    def test_first_canary_disturbed(self):
+        self.write([0] * 10, (1, 0, 0))
+
+        self.assertEqual(self.disturbed(), [0, 1, 2, 3])
+
+    def test_middle_canary_disturbed(self):
+        self.write([0] * 10, (0, 1, 0))
+
+        self.assertEqual(self.disturbed(), [0, 1, 2, 3, 4, 5, 6, 7])
+
+    def test_last_canary_slow(self):
+        self.write([0] * 10, canary_times=(100, 100, 201))
+
+        self.assertEqual(self.disturbed(), [4, 5, 6, 7, 8, 9])
+
+    def test_canary_limit(self):
+        self.write([0] * 10, canary_times=(100, 100, 201))
+
+        self.assertEqual(self.disturbed(canary_limit=3.0), [])
+
+    def test_wrong_count(self):
+        self.write([0] * 10)
+
+        with self.assertRaises(ValueError):
+            self.disturbed(count=11)
+
+
+class TestParseRawTimesDisturbed(unittest.TestCase):
+    """Drop the rows with disturbed samples from the timing file."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        log_file = os.path.join(self.tmpdir, "log.csv")
+        with open(log_file, "w") as log_fp:
+            log_fp.write("A,B\n0,1\n1,0\n0,1\n1,0\n")
+        self.log = Log(log_file)
+        self.log.read_log()
+
+        # two warm-up samples before the 8 of the log file
+        self.raw_times = os.path.join(self.tmpdir, "raw_times.bin")
+        np.arange(100, 110, dtype="<u8").tofile(self.raw_times)
+
+        self.sample_info = os.path.join(self.tmpdir, "sample_info.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def parse(self, disturbed):
+        info = np.zeros(10, dtype=SAMPLE_INFO_DTYPE)
+        info["sequence"] = np.arange(10)
+        info["disturbances"][disturbed] = 1
+        info.tofile(self.sample_info)
+
+        extract = Extract(self.log, output=self.tmpdir,
+                          raw_times=self.raw_times, binary=8,
+                          sample_info=self.sample_info)
+        extract.parse()
+
+        with open(os.path.join(self.tmpdir, "timing.csv")) as timing_fp:
+            self.assertEqual(timing_fp.readline().strip(), "A,B")
+            return np.loadtxt(timing_fp, delimiter=",", ndmin=2).tolist()
+
+    def test_undisturbed(self):
+        self.assertEqual(self.parse([]),
+                         [[102, 103], [105, 104], [106, 107], [109, 108]])
+
+    def test_disturbed_warm_up(self):
+        self.assertEqual(self.parse([0, 1]),
+                         [[102, 103], [105, 104], [106, 107], [109, 108]])
+
+    def test_disturbed_sample(self):
+        # the second sample of class A, its row is dropped in both columns
+        self.assertEqual(self.parse([5]),
+                         [[102, 103], [106, 107], [109, 108]])
+
+    def test_disturbed_samples_of_both_classes(self):
+        self.assertEqual(self.parse([3, 8, 9]), [[105, 104], [106, 107]])
+
+
+if __name__ == '__main__':
+    unittest.main()
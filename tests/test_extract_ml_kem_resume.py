@@ -0,0 +1,146 @@
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from kyber_py.ml_kem import ML_KEM_512
+from kyber_py.ml_kem.pkcs import dk_to_pem
+
+import extract
+from extract import Extract, ML_KEM_CHECKPOINT
+
+
+class Interrupted(Exception):
+    """Simulated interruption of the extraction."""
+
+
+class TestMLKEMResume(unittest.TestCase):
+    """
+    Interrupt ML-KEM extraction and resume it, the output must be the
+    same as of an extraction that wasn't interrupted.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        kem = ML_KEM_512
+        ek, dk = kem.keygen()
+
+        cls.key_file = os.path.join(cls.tmpdir, "dk.pem")
+        with open(cls.key_file, "wb") as key_fp:
+            key_fp.write(dk_to_pem(kem, dk, form="expanded"))
+
+        cls.ciphers_file = os.path.join(cls.tmpdir, "ciphers.bin")
+        with open(cls.ciphers_file, "wb") as ciphers_fp:
+            for i in range(250):
+                if i % 2:
+                    ciphers_fp.write(os.urandom(768))
+                else:
+                    ciphers_fp.write(kem.encaps(ek)[1])
+
+        cls.times_file = os.path.join(cls.tmpdir, "raw_times.csv")
+        with open(cls.times_file, "w") as times_fp:
+            times_fp.write("raw times\n")
+            for i in np.random.default_rng(1).integers(1000, 2000, 250):
+                times_fp.write("{0}\n".format(i))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp(dir=self.tmpdir)
+
+    def extract(self, output, resume=False, interrupt_at=None):
+        """
+        Run the extraction, raise Interrupted when creating the checkpoint
+        number interrupt_at, after creating the previous ones.
+        """
+        checkpoints = [0]
+        write_checkpoint = Extract._ml_kem_write_checkpoint
+
+        def checkpoint(self, *args, **kwargs):
+            checkpoints[0] += 1
+            if checkpoints[0] == interrupt_at:
+                raise Interrupted()
+            write_checkpoint(self, *args, **kwargs)
+
+        extraction = Extract(
+            output=output, raw_times=self.times_file,
+            values=self.ciphers_file, ml_kem_keys=self.key_file,
+            ml_kem_values=["hw-m-prime", "hd-c-c-prime"],
+            output_formats=("csv", "npy"), frequency=1000.0, workers=1,
+            resume=resume)
+
+        with mock.patch("extract.ML_KEM_CHUNK_SIZE", 20), \
+                mock.patch("extract.ML_KEM_CHECKPOINT_INTERVAL", 0), \
+                mock.patch("extract.getrandbits", lambda bits: 42), \
+                mock.patch.object(Extract, "_ml_kem_write_checkpoint",
+                                  checkpoint):
+            extraction.process_ml_kem_keys()
+
+    def assertSameOutput(self, first, second):
+        names = sorted(os.listdir(first))
+        self.assertEqual(names, sorted(os.listdir(second)))
+        self.assertNotIn(ML_KEM_CHECKPOINT, names)
+        for name in names:
+            with open(os.path.join(first, name), "rb") as first_fp:
+                with open(os.path.join(second, name), "rb") as second_fp:
+                    self.assertEqual(first_fp.read(), second_fp.read(), name)
+
+    def test_resume(self):
+        expected = tempfile.mkdtemp(dir=self.tmpdir)
+        self.extract(expected)
+
+        with self.assertRaises(Interrupted):
+            self.extract(self.output, interrupt_at=4)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.output, ML_KEM_CHECKPOINT)))
+
+        self.extract(self.output, resume=True)
+
+        self.assertSameOutput(expected, self.output)
+
+    def test_resume_after_restart_without_checkpoint(self):
+        expected = tempfile.mkdtemp(dir=self.tmpdir)
+        self.extract(expected)
+
+        with self.assertRaises(Interrupted):
+            self.extract(self.output, interrupt_at=6)
+        # started again, interrupted before its first checkpoint
+        with self.assertRaises(Interrupted):
+            self.extract(self.output, interrupt_at=1)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.output, ML_KEM_CHECKPOINT)))
+
+        self.extract(self.output, resume=True)
+
+        self.assertSameOutput(expected, self.output)
+
+    def test_resume_with_different_parameters(self):
+        with self.assertRaises(Interrupted):
+            self.extract(self.output, interrupt_at=2)
+
+        extraction = Extract(
+            output=self.output, raw_times=self.times_file,
+            values=self.ciphers_file, ml_kem_keys=self.key_file,
+            ml_kem_values=["hw-m-prime"], output_formats=("csv", "npy"),
+            frequency=1000.0, workers=1, resume=True)
+
+        with self.assertRaises(ValueError):
+            extraction.process_ml_kem_keys()
+
+
+if __name__ == '__main__':
+    unittest.main()
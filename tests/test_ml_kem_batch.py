@@ -0,0 +1,237 @@
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import os
+
+import numpy as np
+
+from kyber_py.ml_kem import ML_KEM_512, ML_KEM_768, ML_KEM_1024
+
+from extract import Extract
+from ml_kem_batch import PreparedKey, ml_kem_decaps_batch, ML_KEM_METRICS, \
+        SIDE_DATA_DTYPE, SIDE_DATA_KNOWN
+
+
+Q = 3329
+
+
+def _ntt_counts(coeffs, zetas):
+    """
+    FIPS 203 NTT of a single polynomial, one butterfly at a time, return
+    the number of butterfly results needing a correction and the number of
+    multiplications of zeros.
+    """
+    coeffs = [i % Q for i in coeffs]
+    reductions = zeros = 0
+    k, length = 1, 128
+    while length >= 2:
+        for start in range(0, 256, 2 * length):
+            zeta = zetas[k]
+            k += 1
+            for j in range(start, start + length):
+                if coeffs[j + length] == 0:
+                    zeros += 1
+                t = zeta * coeffs[j + length] % Q
+                if coeffs[j] + t >= Q:
+                    reductions += 1
+                if coeffs[j] - t < 0:
+                    reductions += 1
+                coeffs[j + length] = (coeffs[j] - t) % Q
+                coeffs[j] = (coeffs[j] + t) % Q
+        length >>= 1
+    return reductions, zeros
+
+
+def _intt_counts(coeffs, zetas):
+    """Like _ntt_counts(), for the inverse NTT."""
+    coeffs = list(coeffs)
+    reductions = zeros = 0
+    k, length = 127, 2
+    while length <= 128:
+        for start in range(0, 256, 2 * length):
+            zeta = zetas[k]
+            k -= 1
+            for j in range(start, start + length):
+                t = coeffs[j]
+                if t + coeffs[j + length] >= Q:
+                    reductions += 1
+                if coeffs[j + length] - t < 0:
+                    reductions += 1
+                if (coeffs[j + length] - t) % Q == 0:
+                    zeros += 1
+                coeffs[j] = (t + coeffs[j + length]) % Q
+                coeffs[j + length] = zeta * (coeffs[j + length] - t) % Q
+        length <<= 1
+    return reductions, zeros
+
+
+class TestMLKEMDecapsBatch(unittest.TestCase):
+    """
+    Compare ml_kem_decaps_batch() with the reference implementation in
+    Extract._ml_kem_decaps_with_intermediates() and with scalar
+    calculations of the metrics it doesn't provide.
+    """
+
+    def setUp(self):
+        self.extract = Extract()
+
+    def reference(self, key, c):
+        """Return the shared secret and all the metrics of one ciphertext."""
+        kem = key.kem
+        shared_secret, values = \
+            self.extract._ml_kem_decaps_with_intermediates(key, c)
+
+        n = kem.k * kem.du * 32
+        u = kem.M.decode_vector(c[:n], kem.k, kem.du)
+        v = kem.R.decode(c[n:], kem.dv)
+
+        values["bit-size-decompress-u"] = sum(
+            (Q * x + (1 << (kem.du - 1))).bit_length()
+            for i in range(kem.k) for x in u[i, 0].coeffs)
+        values["bit-size-decompress-v"] = sum(
+            (Q * x + (1 << (kem.dv - 1))).bit_length() for x in v.coeffs)
+
+        # kyber-py decompresses and converts to NTT in place
+        u = u.decompress(kem.du)
+        v = v.decompress(kem.dv)
+        zetas = kem.R.ntt_zetas
+
+        counts = [_ntt_counts(u[i, 0].coeffs, zetas) for i in range(kem.k)]
+        values["reductions-ntt-u"] = sum(i for i, _ in counts)
+        values["zeros-ntt-u"] = sum(i for _, i in counts)
+
+        s_hat_dot_u_hat = key.s_hat.dot(u.to_ntt())
+        reductions, zeros = _intt_counts(s_hat_dot_u_hat.coeffs, zetas)
+        values["reductions-intt-s-hat-dot-u-hat"] = reductions
+        values["zeros-intt-s-hat-dot-u-hat"] = zeros
+
+        w = v - s_hat_dot_u_hat.from_ntt()
+        values["bit-size-compress-w"] = sum(
+            ((x << 1) + Q // 2).bit_length() for x in w.coeffs)
+
+        return shared_secret, values
+
+    def ciphertexts(self, kem, ek):
+        """
+        Return valid, bit-flipped and random ciphertexts with the side data
+        of the ciphertexts with known message.
+        """
+        ciphertexts = []
+        side_data = []
+        for _ in range(3):
+            m = os.urandom(32)
+            shared_secret, c = kem._encaps_internal(ek, m)
+            ciphertexts.append(c)
+            side_data.append((SIDE_DATA_KNOWN, m, shared_secret))
+
+            # flip bits in u and in v, the message of the modified
+            # ciphertexts is unknown, as in the side data of ml_kem_encap.py
+            for position in (0, len(c) - 1):
+                flipped = bytearray(c)
+                flipped[position] ^= 0x01
+                ciphertexts.append(bytes(flipped))
+                side_data.append((0, bytes(32), bytes(32)))
+
+        for _ in range(3):
+            ciphertexts.append(os.urandom(len(ciphertexts[0])))
+            side_data.append((0, bytes(32), bytes(32)))
+
+        records = np.zeros(len(side_data), dtype=SIDE_DATA_DTYPE)
+        for record, (flags, m, shared_secret) in zip(records, side_data):
+            record["flags"] = flags
+            record["m"] = np.frombuffer(m, dtype=np.uint8)
+            record["K"] = np.frombuffer(shared_secret, dtype=np.uint8)
+
+        return ciphertexts, records
+
+    def check_parameter_set(self, kem):
+        ek, dk = kem.keygen()
+        key = PreparedKey(kem, dk)
+        ciphertexts, side_data = self.ciphertexts(kem, ek)
+        c = np.frombuffer(b"".join(ciphertexts), dtype=np.uint8).reshape(
+            len(ciphertexts), -1)
+
+        expected = [self.reference(key, i) for i in ciphertexts]
+
+        for side in (None, side_data):
+            shared_secrets, values = ml_kem_decaps_batch(key, c, side)
+
+            self.assertEqual(sorted(values), sorted(ML_KEM_METRICS))
+            for i, (shared_secret, metrics) in enumerate(expected):
+                self.assertEqual(bytes(shared_secrets[i]), shared_secret)
+                self.assertEqual(shared_secret, kem.decaps(dk, ciphertexts[i]))
+                for name in ML_KEM_METRICS:
+                    self.assertEqual(values[name][i], metrics[name],
+                                     "{0} of ciphertext {1}".format(name, i))
+
+            # every metric also when calculated alone, without the
+            # intermediate values needed only by the others
+            for name in ML_KEM_METRICS:
+                _, values = ml_kem_decaps_batch(key, c, side, [name])
+                self.assertEqual(list(values), [name])
+                self.assertEqual(
+                    list(values[name]),
+                    [metrics[name] for _, metrics in expected], name)
+
+    def test_ml_kem_512(self):
+        self.check_parameter_set(ML_KEM_512)
+
+    def test_ml_kem_768(self):
+        self.check_parameter_set(ML_KEM_768)
+
+    def test_ml_kem_1024(self):
+        self.check_parameter_set(ML_KEM_1024)
+
+    def test_side_data_without_re_encryption(self):
+        kem = ML_KEM_768
+        ek, dk = kem.keygen()
+        key = PreparedKey(kem, dk)
+        ciphertexts, side_data = self.ciphertexts(kem, ek)
+        c = np.frombuffer(b"".join(ciphertexts), dtype=np.uint8).reshape(
+            len(ciphertexts), -1)
+
+        shared_secrets, _ = ml_kem_decaps_batch(key, c, side_data, ["hw-w"])
+
+        for i, record in enumerate(side_data):
+            if record["flags"] & SIDE_DATA_KNOWN:
+                self.assertEqual(bytes(shared_secrets[i]),
+                                 kem.decaps(dk, ciphertexts[i]))
+            else:
+                self.assertEqual(bytes(shared_secrets[i]), bytes(32))
+
+    def test_without_side_data_or_re_encryption(self):
+        kem = ML_KEM_512
+        ek, dk = kem.keygen()
+        key = PreparedKey(kem, dk)
+        ciphertexts, _ = self.ciphertexts(kem, ek)
+        c = np.frombuffer(b"".join(ciphertexts), dtype=np.uint8).reshape(
+            len(ciphertexts), -1)
+
+        shared_secrets, values = ml_kem_decaps_batch(key, c, None, ["hw-w"])
+
+        self.assertIsNone(shared_secrets)
+        self.assertEqual(list(values), ["hw-w"])
+
+    def test_unknown_metric(self):
+        kem = ML_KEM_512
+        _, dk = kem.keygen()
+        key = PreparedKey(kem, dk)
+        c = np.zeros((1, 768), dtype=np.uint8)
+
+        with self.assertRaises(ValueError):
+            ml_kem_decaps_batch(key, c, None, ["hw-x"])
+
+    def test_wrong_ciphertext_length(self):
+        kem = ML_KEM_512
+        _, dk = kem.keygen()
+        key = PreparedKey(kem, dk)
+        c = np.zeros((1, 767), dtype=np.uint8)
+
+        with self.assertRaises(ValueError):
+            ml_kem_decaps_batch(key, c)
+
+
+if __name__ == '__main__':
+    unittest.main()